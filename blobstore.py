@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import sys
+
+import catalog
+import config
+import io_pool
+import storage
+
+# Размер блока при чтении файла для подсчета хэша
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_key(sha256):
+    # objects/ab/cd/abcd... - две ступени каталогов, чтобы ни одна папка не разрасталась
+    return f"objects/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def blob_path(sha256):
+    return os.path.join(config.PHOTOS_DIR, *blob_key(sha256).split('/'))
+
+
+async def put_blob(backend, data):
+    # Кладет содержимое в хранилище один раз и возвращает его SHA-256
+    sha256 = await io_pool.run(lambda: hashlib.sha256(data).hexdigest())
+    key = blob_key(sha256)
+    if not await backend.exists(key):
+        await backend.put(key, data)
+    return sha256
+
+
+async def put_blob_file(backend, path):
+    # То же для готового файла: хэш считается потоковым чтением, а файл попадает
+    # в хранилище без чтения в память (для локального диска - жесткой ссылкой)
+    sha256 = await io_pool.run(file_digest, path)
+    key = blob_key(sha256)
+    if not await backend.exists(key):
+        await backend.put_file(key, path)
+    return sha256
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def put_file(path):
+    # Кладет файл в хранилище и возвращает его SHA-256. Если такой блоб уже есть,
+    # файл в папке заменяется жесткой ссылкой на него, и копия на диске не остается
+    sha256 = file_digest(path)
+    blob = blob_path(sha256)
+    if os.path.exists(blob):
+        if not os.path.samefile(blob, path):
+            temp_path = f"{path}.tmp"
+            try:
+                os.link(blob, temp_path)
+            except OSError:
+                return sha256
+            os.replace(temp_path, path)
+        return sha256
+
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(path, blob)
+    except FileExistsError:
+        pass
+    except OSError:
+        # Файловая система без жестких ссылок: блоб хранится отдельной копией
+        shutil.copyfile(path, blob)
+    return sha256
+
+
+def migrate():
+    # Переносит в хранилище фотографии, сохраненные на локальном диске до появления блобов
+    migrated = 0
+    for photo_id, user_id, year, photo_type, category, filename in catalog.photos_without_blob():
+        path = os.path.join(catalog.category_path(user_id, year, photo_type, category), filename)
+        if not os.path.exists(path):
+            continue
+        sha256 = put_file(path)
+        catalog.set_sha256(photo_id, sha256, os.path.getsize(path))
+        migrated += 1
+    return migrated
+
+
+async def collect_garbage(backend):
+    # Удаляет блобы, на которые не ссылается ни одна фотография каталога.
+    # В локальном хранилище удаляются и файлы в objects/, которых нет в каталоге
+    # и на которые нет других ссылок. Запускать, когда бот остановлен
+    removed = 0
+    for sha256 in catalog.unreferenced_blobs():
+        await backend.delete(blob_key(sha256))
+        catalog.delete_blob(sha256)
+        removed += 1
+
+    if isinstance(backend, storage.LocalStorage):
+        objects_dir = backend.path('objects')
+        for root, dirs, files in os.walk(objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.stat(path).st_nlink == 1 and not catalog.is_known_blob(name):
+                    os.remove(path)
+                    removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    # python blobstore.py migrate - перенести существующие фотографии в хранилище блобов
+    # python blobstore.py gc - удалить блобы без ссылок
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    catalog.init_catalog()
+    if command == 'migrate':
+        print(f"Перенесено в хранилище: {migrate()}")
+    elif command == 'gc':
+        print(f"Удалено блобов: {asyncio.run(collect_garbage(storage.get_backend()))}")
+    else:
+        print("Использование: python blobstore.py migrate | gc")
@@ -0,0 +1,486 @@
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+import config
+import layout
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    year TEXT NOT NULL,
+    photo_type TEXT NOT NULL,
+    category TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    file_id TEXT,
+    file_unique_id TEXT,
+    UNIQUE (user_id, year, photo_type, category, filename)
+);
+CREATE TABLE IF NOT EXISTS user_totals (
+    user_id INTEGER PRIMARY KEY,
+    total INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS category_totals (
+    user_id INTEGER NOT NULL,
+    year TEXT NOT NULL,
+    photo_type TEXT NOT NULL,
+    category TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, year, photo_type, category)
+);
+CREATE TABLE IF NOT EXISTS year_totals (
+    user_id INTEGER NOT NULL,
+    year TEXT NOT NULL,
+    photo_type TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, photo_type, year)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    refcount INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Увеличивается при изменении схемы, чтобы пересчитать производные таблицы
+SCHEMA_VERSION = 3
+
+# Колонки, добавленные после первой версии схемы
+PHOTO_COLUMNS = {
+    'file_id': 'TEXT',
+    'file_unique_id': 'TEXT',
+    'sha256': 'TEXT',
+    'dhash': 'TEXT',
+}
+
+# Индексы создаются после добавления недостающих колонок
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_photos_user_type_year
+    ON photos (user_id, photo_type, year, category);
+CREATE INDEX IF NOT EXISTS idx_photos_unique_id
+    ON photos (user_id, file_unique_id);
+CREATE INDEX IF NOT EXISTS idx_photos_sha256
+    ON photos (sha256);
+"""
+
+Photo = namedtuple('Photo', 'id filename file_id file_unique_id sha256')
+
+# Сколько отсортированных списков папок держать в памяти для листания галереи
+LISTING_CACHE_SIZE = 256
+
+_connection = None
+_lock = threading.RLock()
+_listing_cache = OrderedDict()
+
+
+def get_connection():
+    global _connection
+    with _lock:
+        if _connection is None:
+            _connection = sqlite3.connect(config.CATALOG_PATH, check_same_thread=False)
+            _connection.execute("PRAGMA journal_mode=WAL")
+            _connection.execute("PRAGMA synchronous=NORMAL")
+            _connection.executescript(SCHEMA)
+            _add_missing_columns(_connection)
+            _connection.executescript(INDEXES)
+        return _connection
+
+
+def _add_missing_columns(conn):
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(photos)")}
+    for name, column_type in PHOTO_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE photos ADD COLUMN {name} {column_type}")
+
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+def init_catalog():
+    # Индекс строится по дереву photos/ один раз, дальше его ведет save_photo
+    conn = get_connection()
+    with _lock:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'bootstrapped'").fetchone()
+    if row is None:
+        count = bootstrap()
+        print(f"Каталог построен по диску: {count} фотографий")
+        return
+    with _lock, conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        if row is None or int(row[0]) < SCHEMA_VERSION:
+            _rebuild_counters(conn)
+            _set_schema_version(conn)
+
+
+def _set_schema_version(conn):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)",
+                 (str(SCHEMA_VERSION),))
+
+
+def add_photo(user_id, year, photo_type, category, filename, size, created_at=None,
+              file_id=None, file_unique_id=None, sha256=None, dhash=None):
+    if created_at is None:
+        created_at = datetime.now()
+    conn = get_connection()
+    with _lock, conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO photos "
+            "(user_id, year, photo_type, category, filename, size, created_at, "
+            "file_id, file_unique_id, sha256, dhash) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, str(year), photo_type, str(category), filename, size, created_at.isoformat(),
+             file_id, file_unique_id, sha256, _format_dhash(dhash))
+        )
+        if not cursor.rowcount:
+            return None
+        _listing_cache.pop((user_id, str(year), photo_type, str(category)), None)
+        _increment_counters(conn, user_id, str(year), photo_type, str(category), 1)
+        if sha256:
+            _add_blob_reference(conn, sha256, size)
+        return cursor.lastrowid
+
+
+def _format_dhash(dhash):
+    # 64-битный хэш не помещается в знаковый INTEGER SQLite, поэтому хранится в hex
+    return f"{dhash:016x}" if dhash is not None else None
+
+
+def get_dhashes(user_id):
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            "SELECT DISTINCT dhash FROM photos WHERE user_id = ? AND dhash IS NOT NULL",
+            (user_id,)
+        ).fetchall()
+    return [int(row[0], 16) for row in rows]
+
+
+def photos_without_dhash():
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            "SELECT id, user_id, year, photo_type, category, filename FROM photos WHERE dhash IS NULL"
+        ).fetchall()
+    return [(row[0], os.path.join(category_path(*row[1:5]), row[5])) for row in rows]
+
+
+def set_dhash(photo_id, dhash):
+    conn = get_connection()
+    with _lock, conn:
+        conn.execute("UPDATE photos SET dhash = ? WHERE id = ?", (_format_dhash(dhash), photo_id))
+
+
+def _add_blob_reference(conn, sha256, size):
+    conn.execute(
+        "INSERT INTO blobs (sha256, size, refcount) VALUES (?, ?, 1) "
+        "ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1",
+        (sha256, size)
+    )
+
+
+def set_sha256(photo_id, sha256, size):
+    conn = get_connection()
+    with _lock, conn:
+        cursor = conn.execute(
+            "UPDATE photos SET sha256 = ? WHERE id = ? AND sha256 IS NULL",
+            (sha256, photo_id)
+        )
+        if cursor.rowcount:
+            _add_blob_reference(conn, sha256, size)
+
+
+def photos_without_blob():
+    conn = get_connection()
+    with _lock:
+        return conn.execute(
+            "SELECT id, user_id, year, photo_type, category, filename FROM photos WHERE sha256 IS NULL"
+        ).fetchall()
+
+
+def unreferenced_blobs():
+    conn = get_connection()
+    with _lock:
+        return [row[0] for row in conn.execute("SELECT sha256 FROM blobs WHERE refcount <= 0")]
+
+
+def is_known_blob(sha256):
+    conn = get_connection()
+    with _lock:
+        return conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone() is not None
+
+
+def delete_blob(sha256):
+    conn = get_connection()
+    with _lock, conn:
+        conn.execute("DELETE FROM blobs WHERE sha256 = ? AND refcount <= 0", (sha256,))
+
+
+def _increment_counters(conn, user_id, year, photo_type, category, delta):
+    conn.execute(
+        "INSERT INTO user_totals (user_id, total) VALUES (?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET total = total + excluded.total",
+        (user_id, delta)
+    )
+    conn.execute(
+        "INSERT INTO category_totals (user_id, year, photo_type, category, total) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_id, year, photo_type, category) DO UPDATE SET total = total + excluded.total",
+        (user_id, year, photo_type, category, delta)
+    )
+    conn.execute(
+        "INSERT INTO year_totals (user_id, year, photo_type, total) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (user_id, photo_type, year) DO UPDATE SET total = total + excluded.total",
+        (user_id, year, photo_type, delta)
+    )
+
+
+def _rebuild_counters(conn, user_id=None):
+    condition, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    conn.execute(f"DELETE FROM user_totals {condition}", params)
+    conn.execute(f"DELETE FROM category_totals {condition}", params)
+    conn.execute(f"DELETE FROM year_totals {condition}", params)
+    conn.execute(
+        f"INSERT INTO user_totals (user_id, total) "
+        f"SELECT user_id, COUNT(*) FROM photos {condition} GROUP BY user_id",
+        params
+    )
+    conn.execute(
+        f"INSERT INTO category_totals (user_id, year, photo_type, category, total) "
+        f"SELECT user_id, year, photo_type, category, COUNT(*) FROM photos {condition} "
+        f"GROUP BY user_id, year, photo_type, category",
+        params
+    )
+    conn.execute(
+        f"INSERT INTO year_totals (user_id, year, photo_type, total) "
+        f"SELECT user_id, year, photo_type, COUNT(*) FROM photos {condition} "
+        f"GROUP BY user_id, year, photo_type",
+        params
+    )
+    # Блобы общие для всех пользователей, поэтому ссылки на них пересчитываются целиком
+    conn.execute(
+        "UPDATE blobs SET refcount = (SELECT COUNT(*) FROM photos WHERE photos.sha256 = blobs.sha256)"
+    )
+
+
+def list_photos(user_id, year, photo_type, category):
+    key = (user_id, str(year), photo_type, str(category))
+    with _lock:
+        if key in _listing_cache:
+            _listing_cache.move_to_end(key)
+            return _listing_cache[key]
+        rows = get_connection().execute(
+            "SELECT id, filename, file_id, file_unique_id, sha256 FROM photos "
+            "WHERE user_id = ? AND photo_type = ? AND year = ? AND category = ? ORDER BY filename",
+            (user_id, photo_type, str(year), str(category))
+        ).fetchall()
+        photos = [Photo(*row) for row in rows]
+        _listing_cache[key] = photos
+        if len(_listing_cache) > LISTING_CACHE_SIZE:
+            _listing_cache.popitem(last=False)
+    return photos
+
+
+def category_path(user_id, year, photo_type, category):
+    if photo_type == 'model':
+        return os.path.join(layout.user_root(user_id), str(year), 'models', str(category))
+    return os.path.join(layout.user_root(user_id), str(year), 'landscape', str(category))
+
+
+def category_key(user_id, year, photo_type, category):
+    # Ключ папки в хранилище: путь относительно PHOTOS_DIR через '/'
+    relative = os.path.relpath(category_path(user_id, year, photo_type, category), config.PHOTOS_DIR)
+    return relative.replace(os.sep, '/')
+
+
+def find_copies(user_id, file_unique_id):
+    # Все сохраненные копии фотографии пользователя, в любых папках
+    conn = get_connection()
+    with _lock:
+        return conn.execute(
+            "SELECT year, photo_type, category, filename, size, file_id, sha256, dhash FROM photos "
+            "WHERE user_id = ? AND file_unique_id = ?",
+            (user_id, file_unique_id)
+        ).fetchall()
+
+
+def find_photo(photo_id):
+    # Возвращает (user_id, year, photo_type, category) папки, в которой лежит фото
+    conn = get_connection()
+    with _lock:
+        return conn.execute(
+            "SELECT user_id, year, photo_type, category FROM photos WHERE id = ?",
+            (photo_id,)
+        ).fetchone()
+
+
+def set_file_id(photo_id, file_id, file_unique_id):
+    conn = get_connection()
+    with _lock, conn:
+        conn.execute(
+            "UPDATE photos SET file_id = ?, file_unique_id = ? WHERE id = ?",
+            (file_id, file_unique_id, photo_id)
+        )
+        key = find_photo(photo_id)
+        photos = _listing_cache.get(tuple(key)) if key else None
+        if photos:
+            for index, photo in enumerate(photos):
+                if photo.id == photo_id:
+                    photos[index] = photo._replace(file_id=file_id, file_unique_id=file_unique_id)
+                    break
+
+
+def get_total_photos(user_id):
+    conn = get_connection()
+    with _lock:
+        row = conn.execute("SELECT total FROM user_totals WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def get_nonempty_years(user_id, photo_type):
+    # Годы, в которых есть фотографии данного типа, одним запросом по сводке
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            "SELECT year FROM year_totals "
+            "WHERE user_id = ? AND photo_type = ? AND total > 0 ORDER BY year DESC",
+            (user_id, photo_type)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def get_models(user_id, year):
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            "SELECT DISTINCT category FROM photos "
+            "WHERE user_id = ? AND photo_type = 'model' AND year = ? ORDER BY category",
+            (user_id, str(year))
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def get_months(user_id, year):
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            "SELECT DISTINCT category FROM photos "
+            "WHERE user_id = ? AND photo_type = 'landscape' AND year = ?",
+            (user_id, str(year))
+        ).fetchall()
+    return sorted(int(row[0]) for row in rows)
+
+
+def scan_photos(base_dir=None, user_id=None):
+    # Обходит дерево <папка пользователя>/<год>/<models|landscape>/<категория>/<файл>
+    if user_id is not None:
+        user_path = layout.user_root(user_id, base_dir)
+        user_roots = [(user_id, user_path)] if os.path.isdir(user_path) else []
+    else:
+        user_roots = layout.iter_user_roots(base_dir)
+    for user_id, user_path in user_roots:
+        for year in os.listdir(user_path):
+            year_path = os.path.join(user_path, year)
+            if not os.path.isdir(year_path):
+                continue
+            for folder, photo_type in (('models', 'model'), ('landscape', 'landscape')):
+                type_path = os.path.join(year_path, folder)
+                if not os.path.isdir(type_path):
+                    continue
+                for category in os.listdir(type_path):
+                    category_path = os.path.join(type_path, category)
+                    if not os.path.isdir(category_path):
+                        continue
+                    with os.scandir(category_path) as entries:
+                        for entry in entries:
+                            if not entry.name.endswith(PHOTO_EXTENSIONS):
+                                continue
+                            stat = entry.stat()
+                            yield (user_id, year, photo_type, category, entry.name,
+                                   stat.st_size, datetime.fromtimestamp(stat.st_mtime))
+
+
+def bootstrap(base_dir=None):
+    conn = get_connection()
+    count = 0
+    with _lock, conn:
+        for user_id, year, photo_type, category, filename, size, created_at in scan_photos(base_dir):
+            conn.execute(
+                "INSERT OR IGNORE INTO photos (user_id, year, photo_type, category, filename, size, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, year, photo_type, category, filename, size, created_at.isoformat())
+            )
+            count += 1
+        _rebuild_counters(conn)
+        _set_schema_version(conn)
+        _listing_cache.clear()
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bootstrapped', ?)",
+                     (datetime.now().isoformat(),))
+    return count
+
+
+def reconcile(base_dir=None, user_id=None):
+    # Сверяет индекс с диском и пересчитывает счетчики, если они разошлись.
+    # Папки с файлами есть только у локального хранилища: для S3 сверка с пустым
+    # PHOTOS_DIR удалила бы весь индекс, а за ним сборка мусора - все блобы
+    if config.STORAGE_BACKEND != 'local':
+        raise RuntimeError(f"Сверка с диском работает только с локальным хранилищем, "
+                           f"а выбрано {config.STORAGE_BACKEND!r}")
+    conn = get_connection()
+    added = removed = 0
+    with _lock, conn:
+        condition, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+        indexed = {
+            row[1:]: row[0] for row in conn.execute(
+                f"SELECT id, user_id, year, photo_type, category, filename FROM photos {condition}", params
+            )
+        }
+        on_disk = set()
+        for photo_user, year, photo_type, category, filename, size, created_at in scan_photos(base_dir, user_id):
+            key = (photo_user, year, photo_type, category, filename)
+            on_disk.add(key)
+            if key not in indexed:
+                conn.execute(
+                    "INSERT INTO photos (user_id, year, photo_type, category, filename, size, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    key + (size, created_at.isoformat())
+                )
+                added += 1
+        for key, photo_id in indexed.items():
+            if key not in on_disk:
+                conn.execute("DELETE FROM photos WHERE id = ?", (photo_id,))
+                removed += 1
+        _rebuild_counters(conn, user_id)
+        _listing_cache.clear()
+    return added, removed
+
+
+if __name__ == '__main__':
+    # python catalog.py bootstrap - перестроить индекс по папке photos/
+    # python catalog.py reconcile [user_id] - сверить индекс и счетчики с диском
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'bootstrap':
+        print(f"Проиндексировано фотографий: {bootstrap()}")
+    elif command == 'reconcile':
+        try:
+            added, removed = reconcile(user_id=int(sys.argv[2]) if len(sys.argv) > 2 else None)
+            print(f"Добавлено в индекс: {added}, удалено из индекса: {removed}")
+        except RuntimeError as e:
+            print(e)
+    else:
+        print("Использование: python catalog.py bootstrap | reconcile [user_id]")
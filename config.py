@@ -0,0 +1,100 @@
+import os
+
+# Корневая папка с фотографиями пользователей
+PHOTOS_DIR = os.environ.get('PHOTOS_DIR', 'photos')
+
+# База данных каталога фотографий (SQLite)
+CATALOG_PATH = os.environ.get('CATALOG_PATH', 'catalog.db')
+
+# Режим отправки галереи: 'album' - альбомами через send_media_group, 'single' - по одной,
+# 'carousel' - одно сообщение, фотографии в котором меняются кнопками ◀️/▶️
+GALLERY_MODE = os.environ.get('GALLERY_MODE', 'album')
+# Количество фотографий в одном альбоме (Telegram допускает от 2 до 10)
+MEDIA_GROUP_SIZE = min(max(int(os.environ.get('MEDIA_GROUP_SIZE', '10')), 2), 10)
+# Количество фотографий на одной странице галереи
+PAGE_SIZE = max(int(os.environ.get('PAGE_SIZE', '10')), 1)
+
+# Пауза без новых фотографий (в секундах), после которой загрузка считается завершенной
+COMPLETION_DELAY = float(os.environ.get('COMPLETION_DELAY', '3'))
+
+# Сколько ждать следующую часть альбома (в секундах), прежде чем скачивать его целиком
+ALBUM_COLLECT_DELAY = float(os.environ.get('ALBUM_COLLECT_DELAY', '1'))
+
+# Сколько воркеров одновременно скачивают фотографии
+DOWNLOAD_WORKERS = max(int(os.environ.get('DOWNLOAD_WORKERS', '4')), 1)
+# Максимальный размер очереди скачивания и сколько секунд ждать места в ней
+DOWNLOAD_QUEUE_SIZE = max(int(os.environ.get('DOWNLOAD_QUEUE_SIZE', '1000')), 1)
+DOWNLOAD_QUEUE_TIMEOUT = float(os.environ.get('DOWNLOAD_QUEUE_TIMEOUT', '10'))
+# Как часто (в секундах) печатать метрики очереди, 0 - не печатать
+DOWNLOAD_METRICS_INTERVAL = float(os.environ.get('DOWNLOAD_METRICS_INTERVAL', '60'))
+
+# Поиск похожих фотографий: максимальное расстояние Хэмминга между dHash (из 64 бит)
+NEAR_DUPLICATE_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_DISTANCE', '6'))
+# Что делать с похожей фотографией: 'flag' - сохранить и сообщить, 'skip' - не сохранять
+NEAR_DUPLICATE_MODE = os.environ.get('NEAR_DUPLICATE_MODE', 'flag')
+
+# Раскладка папок пользователей: 1 - photos/user_<id>, 2 - photos/<ab>/<cd>/user_<id>
+STORAGE_LAYOUT_VERSION = int(os.environ.get('STORAGE_LAYOUT_VERSION', '1'))
+
+# Хранилище фотографий: 'local' - папка PHOTOS_DIR, 's3' - S3-совместимый бакет (например, MinIO).
+# Блобы лежат в нем под ключами objects/<ab>/<cd>/<sha256>
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'photos')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+S3_REGION = os.environ.get('S3_REGION')
+
+# Размер пула потоков для блокирующих операций (диск, SQLite)
+IO_THREADS = max(int(os.environ.get('IO_THREADS', '8')), 1)
+# Отладка: сообщать о шагах цикла событий дольше указанного числа миллисекунд, 0 - выключено
+DEBUG_BLOCKING_MS = float(os.environ.get('DEBUG_BLOCKING_MS', '0'))
+
+# Сессии пользователей (состояние диалога и user_data) переживают перезапуск бота
+PERSISTENCE_PATH = os.environ.get('PERSISTENCE_PATH', 'sessions.db')
+# Как часто (в секундах) изменения сессий пакетом записываются в базу
+PERSISTENCE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', '30'))
+# Сессии, простаивающие дольше SESSION_TTL секунд, и лишние сверх MAX_SESSIONS выгружаются из памяти в базу
+SESSION_TTL = float(os.environ.get('SESSION_TTL', '1800'))
+MAX_SESSIONS = max(int(os.environ.get('MAX_SESSIONS', '10000')), 1)
+# Как часто (в секундах) выгружать простаивающие сессии и печатать отчет о памяти
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '60'))
+
+# Как получать обновления: 'polling' - long polling, 'webhook' - встроенный HTTP-сервер
+TRANSPORT = os.environ.get('TRANSPORT', 'polling')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+# Публичный адрес бота (https://...), на который Telegram шлет обновления. Без него вебхук
+# в Telegram не регистрируется - удобно для локальной проверки через python webhook.py post
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# Сертификат и ключ нужны, только если TLS не снимает прокси перед ботом
+WEBHOOK_CERT = os.environ.get('WEBHOOK_CERT')
+WEBHOOK_KEY = os.environ.get('WEBHOOK_KEY')
+HEALTH_PATH = os.environ.get('HEALTH_PATH', '/health')
+# Сколько секунд при остановке ждать обработки уже принятых обновлений и скачивания
+# уже принятых фотографий
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '30'))
+# Сколько секунд после сигнала остановки вебхук еще принимает соединения и отвечает 503
+# на health и новые обновления, чтобы балансировщик успел вывести бота из ротации
+DRAIN_GRACE_PERIOD = float(os.environ.get('DRAIN_GRACE_PERIOD', '5'))
+
+# Сколько процессов-воркеров обрабатывают обновления. При WORKERS > 1 основной процесс
+# только получает обновления и раздает их воркерам по id пользователя
+WORKERS = max(int(os.environ.get('WORKERS', '1')), 1)
+
+# Сколько обновлений разных пользователей обрабатывать одновременно (обновления одного - по очереди)
+CONCURRENT_UPDATES = max(int(os.environ.get('CONCURRENT_UPDATES', '32')), 1)
+
+# Адрес локального сервера Bot API, запущенного с --local (например, http://localhost:8081).
+# Фотографии тогда берутся с его диска жесткой ссылкой, без скачивания по HTTP
+BOT_API_URL = os.environ.get('BOT_API_URL')
+
+# Ограничение исходящих сообщений: всего в секунду, в секунду на чат и в минуту на группу
+RATE_LIMIT_GLOBAL = float(os.environ.get('RATE_LIMIT_GLOBAL', '30'))
+RATE_LIMIT_CHAT = float(os.environ.get('RATE_LIMIT_CHAT', '1'))
+RATE_LIMIT_GROUP = float(os.environ.get('RATE_LIMIT_GROUP', '20'))
+
+# Статус загрузки изменяется не чаще раза в столько секунд
+STATUS_UPDATE_INTERVAL = float(os.environ.get('STATUS_UPDATE_INTERVAL', '2'))
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+
+class Debouncer:
+    # Таймер по ключу: каждый вызов trigger переносит срабатывание, и после паузы
+    # длиной delay колбэк вызывается ровно один раз
+
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self.callback = callback
+        self._tasks = {}
+
+    def trigger(self, key, *args, **kwargs):
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+        self._tasks[key] = asyncio.create_task(self._run(key, args, kwargs))
+
+    def cancel(self, key):
+        # Отменяет только ожидающий таймер: уже запущенный колбэк доработает до конца
+        task = self._tasks.pop(key, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    def pending(self, key):
+        return key in self._tasks
+
+    async def _run(self, key, args, kwargs):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            return
+        if self._tasks.get(key) is asyncio.current_task():
+            del self._tasks[key]
+        try:
+            await self.callback(*args, **kwargs)
+        except Exception as e:
+            print(f"Ошибка в отложенном обработчике: {e}")
+
+
+class Throttler:
+    # Колбэк по ключу вызывается не чаще раза в interval секунд. Вызовы trigger
+    # между срабатываниями схлопываются, и колбэк получает аргументы последнего из них
+
+    def __init__(self, interval, callback):
+        self.interval = interval
+        self.callback = callback
+        self._tasks = {}
+        self._args = {}
+        self._last_call = {}
+
+    def trigger(self, key, *args, **kwargs):
+        self._args[key] = (args, kwargs)
+        if key in self._tasks:
+            return
+        delay = max(self._last_call.get(key, 0) + self.interval - time.monotonic(), 0)
+        self._tasks[key] = asyncio.create_task(self._run(key, delay))
+
+    async def finish(self, key):
+        # Сразу отправляет последнее значение, если оно еще не отправлено, и забывает ключ
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+        if key in self._args:
+            await self._call(key)
+        self._last_call.pop(key, None)
+
+    def cancel(self, key):
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+        self._args.pop(key, None)
+        self._last_call.pop(key, None)
+
+    async def _run(self, key, delay):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            return
+        if self._tasks.get(key) is asyncio.current_task():
+            del self._tasks[key]
+        await self._call(key)
+
+    async def _call(self, key):
+        args, kwargs = self._args.pop(key)
+        self._last_call[key] = time.monotonic()
+        try:
+            await self.callback(*args, **kwargs)
+        except Exception as e:
+            print(f"Ошибка в отложенном обработчике: {e}")
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+import blobstore
+import catalog
+import config
+import io_pool
+import ratelimit
+import storage
+
+# Сколько заранее прочитанных файлов держать для карусели
+PREFETCH_CACHE_SIZE = 32
+
+_prefetched = OrderedDict()
+
+
+def content_key(folder_key, photo):
+    # Содержимое читается из блоба, а для фотографий до появления блобов - из папки
+    if photo.sha256:
+        return blobstore.blob_key(photo.sha256)
+    return f"{folder_key}/{photo.filename}"
+
+
+async def read_photo(folder_key, photo):
+    data = _prefetched.pop(photo.id, None)
+    if data is None:
+        data = await storage.get_backend().read(content_key(folder_key, photo))
+    return data
+
+
+async def send_photo(bot, chat_id, folder_key, photo, **kwargs):
+    # Повторная отправка по file_id не загружает файл в Telegram заново
+    if photo.file_id:
+        try:
+            return await bot.send_photo(chat_id, photo=photo.file_id, **kwargs)
+        except BadRequest as e:
+            print(f"Telegram отклонил file_id, отправляю файл из хранилища: {e}")
+
+    message = await bot.send_photo(chat_id, photo=await read_photo(folder_key, photo), **kwargs)
+
+    sent = message.photo[-1]
+    await io_pool.run(catalog.set_file_id, photo.id, sent.file_id, sent.file_unique_id)
+    return message
+
+
+async def read_media(folder_key, photos):
+    # Фотографии, которые не удалось прочитать из хранилища, выпадают из альбома,
+    # а остальные отправляются как обычно
+    readable, media = [], []
+    for photo in photos:
+        if photo.file_id:
+            media.append(InputMediaPhoto(photo.file_id))
+        else:
+            try:
+                media.append(InputMediaPhoto(await read_photo(folder_key, photo)))
+            except storage.READ_ERRORS as e:
+                print(f"Не удалось прочитать фото {photo.filename}: {e}")
+                continue
+        readable.append(photo)
+    return readable, media
+
+
+async def send_photos_one_by_one(bot, chat_id, folder_key, photos, **kwargs):
+    # Ошибка одной фотографии не останавливает отправку остальных
+    messages = []
+    for photo in photos:
+        try:
+            messages.append(await send_photo(bot, chat_id, folder_key, photo, **kwargs))
+        except (BadRequest,) + storage.READ_ERRORS as e:
+            print(f"Не удалось отправить фото {photo.filename}: {e}")
+    return messages
+
+
+async def send_album(bot, chat_id, folder_key, photos, **kwargs):
+    if len(photos) == 1:
+        return await send_photos_one_by_one(bot, chat_id, folder_key, photos, **kwargs)
+
+    photos, media = await read_media(folder_key, photos)
+    if len(photos) < 2:
+        return await send_photos_one_by_one(bot, chat_id, folder_key, photos, **kwargs)
+
+    try:
+        messages = await bot.send_media_group(chat_id, media=media, **kwargs)
+    except BadRequest as e:
+        # Альбом отклоняется целиком, поэтому досылаем фотографии по одной,
+        # чтобы потерялись только действительно сломанные
+        print(f"Ошибка отправки альбома, отправляю по одной: {e}")
+        return await send_photos_one_by_one(bot, chat_id, folder_key, photos, **kwargs)
+
+    for photo, message in zip(photos, messages):
+        sent = message.photo[-1]
+        if sent.file_id != photo.file_id:
+            await io_pool.run(catalog.set_file_id, photo.id, sent.file_id, sent.file_unique_id)
+    return messages
+
+
+async def send_gallery(bot, chat_id, folder_key, photos, batch_size=None):
+    # Галерея отправляется с низким приоритетом и не задерживает ответы другим пользователям
+    if config.GALLERY_MODE == 'single':
+        await send_photos_one_by_one(bot, chat_id, folder_key, photos, rate_limit_args=ratelimit.BULK)
+        return
+
+    batch_size = batch_size or config.MEDIA_GROUP_SIZE
+    for start in range(0, len(photos), batch_size):
+        await send_album(bot, chat_id, folder_key, photos[start:start + batch_size], rate_limit_args=ratelimit.BULK)
+
+
+def get_page(photos, cursor=None, page_size=None):
+    # Курсор - id первой фотографии страницы, так страницы не сдвигаются при добавлении новых файлов
+    page_size = page_size or config.PAGE_SIZE
+    start = 0
+    if cursor is not None:
+        for index, photo in enumerate(photos):
+            if photo.id == cursor:
+                start = index
+                break
+
+    page = photos[start:start + page_size]
+    prev_id = photos[max(start - page_size, 0)].id if start > 0 else None
+    next_id = photos[start + page_size].id if start + page_size < len(photos) else None
+    return page, start, prev_id, next_id
+
+
+async def edit_photo(bot, chat_id, message_id, folder_key, photo, caption=None, reply_markup=None):
+    # Карусель: фотография в уже отправленном сообщении заменяется без новых сообщений
+    if photo.file_id:
+        try:
+            return await bot.edit_message_media(
+                InputMediaPhoto(photo.file_id, caption=caption),
+                chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+            )
+        except BadRequest as e:
+            print(f"Telegram отклонил file_id, отправляю файл из хранилища: {e}")
+
+    message = await bot.edit_message_media(
+        InputMediaPhoto(await read_photo(folder_key, photo), caption=caption),
+        chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+    )
+    sent = message.photo[-1]
+    await io_pool.run(catalog.set_file_id, photo.id, sent.file_id, sent.file_unique_id)
+    return message
+
+
+def get_neighbours(photos, photo_id):
+    # Индекс текущей фотографии и соседние по кругу
+    for index, photo in enumerate(photos):
+        if photo.id == photo_id:
+            return index, photos[index - 1], photos[(index + 1) % len(photos)]
+    return None, None, None
+
+
+async def prefetch(folder_key, photos):
+    # file_id соседей уже есть в закэшированном списке папки, а файлы без file_id
+    # читаются из хранилища заранее, чтобы следующее листание не ждало
+    for photo in photos:
+        if photo.file_id or photo.id in _prefetched:
+            continue
+        try:
+            _prefetched[photo.id] = await read_photo(folder_key, photo)
+        except Exception as e:
+            print(f"Не удалось прочитать фото {photo.filename}: {e}")
+            continue
+        while len(_prefetched) > PREFETCH_CACHE_SIZE:
+            _prefetched.popitem(last=False)
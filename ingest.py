@@ -0,0 +1,279 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime
+
+import blobstore
+import catalog
+import config
+import io_pool
+import phash
+import storage
+from debounce import Debouncer
+
+# Куда сохраняется фотография: пользователь, чат, год, тип, модель или месяц и ключ папки в хранилище
+UploadTarget = namedtuple('UploadTarget', 'user_id chat_id year photo_type category folder_key')
+
+
+# Результаты сохранения и проверки на повтор
+PHOTO_SAVED = 'saved'
+DUPLICATE_SKIPPED = 'skipped'
+DUPLICATE_LINKED = 'linked'
+NEAR_DUPLICATE_FLAGGED = 'similar'
+
+
+def _new_filename(photo):
+    # file_unique_id в имени не дает совпасть именам фотографий, скачанных параллельно
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{photo.file_unique_id}.jpg"
+
+
+async def check_duplicate(target, photo):
+    # Повторно присланное фото не скачивается: если оно уже есть в этой папке, его
+    # пропускаем, а если в другой - ссылаемся на уже сохраненное содержимое
+    copies = await io_pool.run(catalog.find_copies, target.user_id, photo.file_unique_id)
+    if not copies:
+        return None
+    for year, photo_type, category, filename, size, file_id, sha256, dhash in copies:
+        if (year, photo_type, category) == (str(target.year), target.photo_type, str(target.category)):
+            return DUPLICATE_SKIPPED
+
+    year, photo_type, category, filename, size, file_id, sha256, dhash = copies[0]
+    backend = storage.get_backend()
+    new_filename = _new_filename(photo)
+    if sha256:
+        source_key = blobstore.blob_key(sha256)
+    else:
+        folder_key = await io_pool.run(catalog.category_key, target.user_id, year, photo_type, category)
+        source_key = f"{folder_key}/{filename}"
+    if not await backend.exists(source_key):
+        return None
+    # Без дешевых ссылок запись в папке - только строка каталога, содержимое берется из блоба
+    if backend.supports_links or not sha256:
+        await backend.link(source_key, f"{target.folder_key}/{new_filename}")
+    await io_pool.run(catalog.add_photo, target.user_id, target.year, target.photo_type, target.category,
+                      new_filename, size, file_id=file_id or photo.file_id,
+                      file_unique_id=photo.file_unique_id, sha256=sha256,
+                      dhash=int(dhash, 16) if dhash else None)
+    return DUPLICATE_LINKED
+
+
+def _local_file_path(file):
+    # Локальный сервер Bot API (--local) отдает вместо ссылки абсолютный путь к файлу
+    # на своем диске. Если этот путь виден боту, файл не нужно скачивать по HTTP
+    path = file.file_path
+    if path and os.path.isabs(path) and os.path.isfile(path):
+        return path
+    return None
+
+
+async def store_photo(bot, target, photo):
+    file = await bot.get_file(photo.file_id)
+    local_path = await io_pool.run(_local_file_path, file)
+    if local_path:
+        data = None
+        size = await io_pool.run(os.path.getsize, local_path)
+    else:
+        data = bytes(await file.download_as_bytearray())
+        size = len(data)
+
+    # Похожие кадры (серии, пересжатые пересылки) ищутся по перцептивному хэшу
+    dhash = await io_pool.run(phash.compute_dhash, local_path or data)
+    similar = []
+    if dhash is not None:
+        similar = await phash.find_similar(target.user_id, dhash, config.NEAR_DUPLICATE_DISTANCE)
+    if similar and config.NEAR_DUPLICATE_MODE == 'skip':
+        return DUPLICATE_SKIPPED
+
+    # Содержимое хранится один раз как блоб, а файл в папке - ссылка на него
+    backend = storage.get_backend()
+    if local_path:
+        sha256 = await blobstore.put_blob_file(backend, local_path)
+    else:
+        sha256 = await blobstore.put_blob(backend, data)
+    filename = _new_filename(photo)
+    if backend.supports_links:
+        await backend.link(blobstore.blob_key(sha256), f"{target.folder_key}/{filename}")
+    await io_pool.run(catalog.add_photo, target.user_id, target.year, target.photo_type, target.category,
+                      filename, size,
+                      file_id=photo.file_id, file_unique_id=photo.file_unique_id,
+                      sha256=sha256, dhash=dhash)
+    if dhash is not None:
+        phash.remember(target.user_id, dhash)
+    return NEAR_DUPLICATE_FLAGGED if similar else PHOTO_SAVED
+
+
+class DownloadQueueFull(Exception):
+    pass
+
+
+class DownloadQueue:
+    # Очередь скачивания, которую разбирают несколько воркеров. Задачи хранятся
+    # в отдельной очереди на каждого пользователя, и воркеры обходят пользователей
+    # по кругу, чтобы большой альбом одного пользователя не задерживал остальных
+
+    def __init__(self, workers, max_size, put_timeout, report_interval=0):
+        self.workers = workers
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+        self.report_interval = report_interval
+        self.enqueued = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_progress = 0
+        self._queues = OrderedDict()
+        self._size = 0
+        self._completed_times = deque()
+        self._condition = None
+        self._tasks = []
+
+    async def start(self):
+        self._condition = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.report_interval:
+            self._tasks.append(asyncio.create_task(self._report()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self, timeout):
+        # Ждет, пока скачаются уже принятые фотографии, но не дольше timeout секунд
+        deadline = time.monotonic() + timeout
+        while (self._size or self.in_progress) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        left = self._size + self.in_progress
+        if left:
+            print(f"Не дождались скачивания фотографий: {left}")
+
+    async def submit(self, bot, target, photo):
+        # Возвращает future с результатом store_photo. Если очередь заполнена,
+        # ждет освобождения места не дольше put_timeout секунд
+        future = asyncio.get_running_loop().create_future()
+        async with self._condition:
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self._size < self.max_size),
+                    self.put_timeout
+                )
+            except asyncio.TimeoutError:
+                raise DownloadQueueFull(f"В очереди уже {self._size} фотографий")
+            self._queues.setdefault(target.user_id, deque()).append((bot, target, photo, future))
+            self._size += 1
+            self.enqueued += 1
+            self._condition.notify_all()
+        return future
+
+    def metrics(self):
+        now = time.monotonic()
+        while self._completed_times and now - self._completed_times[0] > 60:
+            self._completed_times.popleft()
+        return {
+            'depth': self._size,
+            'users': len(self._queues),
+            'in_progress': self.in_progress,
+            'enqueued': self.enqueued,
+            'completed': self.completed,
+            'failed': self.failed,
+            'per_minute': len(self._completed_times),
+        }
+
+    async def _next_job(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._size > 0)
+            user_id, jobs = self._queues.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                # Пользователь с оставшимися задачами встает в конец круга
+                self._queues[user_id] = jobs
+            self._size -= 1
+            self._condition.notify_all()
+            return job
+
+    async def _worker(self):
+        while True:
+            bot, target, photo, future = await self._next_job()
+            self.in_progress += 1
+            try:
+                result = await store_photo(bot, target, photo)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                self._completed_times.append(time.monotonic())
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.in_progress -= 1
+
+    async def _report(self):
+        last_enqueued = None
+        while True:
+            await asyncio.sleep(self.report_interval)
+            if self.enqueued == last_enqueued and not self._size:
+                continue
+            last_enqueued = self.enqueued
+            print("Очередь загрузки: " + ", ".join(f"{key}={value}" for key, value in self.metrics().items()))
+
+
+class AlbumCollector:
+    # Собирает фотографии альбома по media_group_id и, когда новые части перестают
+    # приходить, отправляет альбом целиком в очередь скачивания
+
+    def __init__(self, delay, download_queue, on_complete):
+        self.download_queue = download_queue
+        self.on_complete = on_complete
+        self._albums = {}
+        self._timer = Debouncer(delay, self._flush)
+
+    def add(self, media_group_id, context, target, photo):
+        album = self._albums.setdefault(media_group_id, {'context': context, 'target': target, 'photos': []})
+        album['photos'].append(photo)
+        self._timer.trigger(media_group_id, media_group_id)
+
+    def discard_user(self, user_id):
+        for media_group_id in [key for key, album in self._albums.items() if album['target'].user_id == user_id]:
+            self._timer.cancel(media_group_id)
+            del self._albums[media_group_id]
+
+    async def _flush(self, media_group_id):
+        album = self._albums.pop(media_group_id, None)
+        if album is None:
+            return
+
+        context, target = album['context'], album['target']
+        counts = {'saved': 0, 'failed': 0, 'skipped': 0, 'similar': 0}
+        futures = []
+        for photo in album['photos']:
+            duplicate = await check_duplicate(target, photo)
+            if duplicate == DUPLICATE_SKIPPED:
+                counts['skipped'] += 1
+                continue
+            if duplicate == DUPLICATE_LINKED:
+                counts['saved'] += 1
+                continue
+            try:
+                futures.append(await self.download_queue.submit(context.bot, target, photo))
+            except DownloadQueueFull as e:
+                print(f"Ошибка при сохранении фото из альбома: {e}")
+                counts['failed'] += 1
+
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(f"Ошибка при сохранении фото из альбома: {result}")
+                counts['failed'] += 1
+            elif result == DUPLICATE_SKIPPED:
+                counts['skipped'] += 1
+            else:
+                counts['saved'] += 1
+                if result == NEAR_DUPLICATE_FLAGGED:
+                    counts['similar'] += 1
+
+        await self.on_complete(context, target, counts)
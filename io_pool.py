@@ -0,0 +1,39 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=config.IO_THREADS, thread_name_prefix='io')
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    # Блокирующие вызовы (диск, SQLite) выполняются в отдельном ограниченном пуле потоков,
+    # чтобы не останавливать цикл событий и не занимать пул по умолчанию
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def report_blocking_calls(loop, threshold_ms):
+    # Режим отладки asyncio: любой шаг цикла дольше threshold_ms попадает в лог
+    # с указанием корутины, которая его выполняла
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.WARNING)
+    loop.set_debug(True)
+    loop.slow_callback_duration = threshold_ms / 1000
+    print(f"Отчет о блокирующих вызовах длиннее {threshold_ms} мс включен")
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# Версии раскладки папок пользователей:
+# 1 - photos/user_<id>, 2 - photos/<ab>/<cd>/user_<id>, где ab и cd - начало хэша от id
+LAYOUT_FLAT = 1
+LAYOUT_SHARDED = 2
+
+# Сколько раз пытаться убрать старую папку, если бот продолжает в нее писать
+MERGE_ATTEMPTS = 5
+
+
+def flat_user_root(user_id, base_dir=None):
+    return os.path.join(base_dir or config.PHOTOS_DIR, f"user_{user_id}")
+
+
+def sharded_user_root(user_id, base_dir=None):
+    digest = hashlib.sha256(str(user_id).encode()).hexdigest()
+    return os.path.join(base_dir or config.PHOTOS_DIR, digest[:2], digest[2:4], f"user_{user_id}")
+
+
+def user_root(user_id, base_dir=None):
+    if config.STORAGE_LAYOUT_VERSION != LAYOUT_SHARDED:
+        return flat_user_root(user_id, base_dir)
+
+    sharded = sharded_user_root(user_id, base_dir)
+    if os.path.exists(sharded):
+        return sharded
+    # Пока миграция не дошла до пользователя, его файлы остаются по старому пути
+    flat = flat_user_root(user_id, base_dir)
+    if os.path.isdir(flat) and not os.path.islink(flat):
+        return flat
+    return sharded
+
+
+def _parse_user_dir(name):
+    if not name.startswith('user_'):
+        return None
+    try:
+        return int(name[len('user_'):])
+    except ValueError:
+        return None
+
+
+def _is_shard(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def iter_user_roots(base_dir=None):
+    # Папки пользователей в обеих раскладках. Ссылки, оставленные миграцией
+    # на старом месте, пропускаются, чтобы не посчитать пользователя дважды
+    base_dir = base_dir or config.PHOTOS_DIR
+    if not os.path.exists(base_dir):
+        return
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            user_id = _parse_user_dir(entry.name)
+            if user_id is not None:
+                if entry.is_dir(follow_symlinks=False):
+                    yield user_id, entry.path
+            elif _is_shard(entry.name) and entry.is_dir(follow_symlinks=False):
+                for shard in os.listdir(entry.path):
+                    shard_path = os.path.join(entry.path, shard)
+                    if not _is_shard(shard) or not os.path.isdir(shard_path):
+                        continue
+                    for name in os.listdir(shard_path):
+                        user_id = _parse_user_dir(name)
+                        if user_id is not None:
+                            yield user_id, os.path.join(shard_path, name)
+
+
+def _merge_tree(source, destination):
+    # Переносит файлы, созданные по старому пути уже после переноса папки.
+    # Папки удаляются снизу вверх и только пустыми: файл, который бот положил
+    # в уже пройденную папку, не удаляется, а переносится следующим проходом
+    for _ in range(MERGE_ATTEMPTS):
+        for root, dirs, files in os.walk(source, topdown=False):
+            target_root = os.path.join(destination, os.path.relpath(root, source))
+            os.makedirs(target_root, exist_ok=True)
+            for name in files:
+                os.replace(os.path.join(root, name), os.path.join(target_root, name))
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+        if not os.path.lexists(source):
+            return
+    raise OSError(f"Папка {source} не освободилась за {MERGE_ATTEMPTS} проходов")
+
+
+def migrate_user(user_id, base_dir=None):
+    # Переносит папку пользователя в шардированную раскладку. На старом месте
+    # остается символическая ссылка, поэтому работающий бот не теряет файлы.
+    # Повторный запуск продолжает с того места, где перенос остановился
+    flat = flat_user_root(user_id, base_dir)
+    sharded = sharded_user_root(user_id, base_dir)
+    if os.path.islink(flat) or not os.path.isdir(flat):
+        return False
+
+    os.makedirs(os.path.dirname(sharded), exist_ok=True)
+    if os.path.exists(sharded):
+        _merge_tree(flat, sharded)
+    else:
+        os.rename(flat, sharded)
+
+    link_path = f"{flat}.link"
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.relpath(sharded, os.path.dirname(flat)), link_path)
+    for _ in range(MERGE_ATTEMPTS):
+        try:
+            os.replace(link_path, flat)
+            return True
+        except OSError:
+            # Бот успел создать папку по старому пути между переименованиями
+            _merge_tree(flat, sharded)
+    raise OSError(f"Не удалось заменить {flat} ссылкой")
+
+
+def _migrate_user_safely(user_id, base_dir):
+    # Ошибка одного пользователя не останавливает перенос остальных,
+    # а его папка перенесется повторным запуском
+    try:
+        return migrate_user(user_id, base_dir)
+    except OSError as e:
+        print(f"Не удалось перенести пользователя {user_id}: {e}")
+        return False
+
+
+def migrate(base_dir=None, workers=8):
+    base_dir = base_dir or config.PHOTOS_DIR
+    user_ids = [user_id for user_id, path in iter_user_roots(base_dir) if path == flat_user_root(user_id, base_dir)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda user_id: _migrate_user_safely(user_id, base_dir), user_ids))
+    return sum(results)
+
+
+def remove_links(base_dir=None):
+    # Удаляет ссылки на старом месте, когда бот уже работает с раскладкой версии 2
+    base_dir = base_dir or config.PHOTOS_DIR
+    removed = 0
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            if _parse_user_dir(entry.name) is not None and entry.is_symlink():
+                os.remove(entry.path)
+                removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    # python layout.py migrate [workers] - перенести пользователей в раскладку версии 2
+    # python layout.py cleanup - удалить ссылки на старом месте после переключения бота
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'migrate':
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+        print(f"Перенесено пользователей: {migrate(workers=workers)}")
+    elif command == 'cleanup':
+        print(f"Удалено ссылок: {remove_links()}")
+    else:
+        print("Использование: python layout.py migrate [workers] | cleanup")
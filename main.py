@@ -1,8 +1,23 @@
-import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ConversationHandler
+from telegram.ext import Application, CallbackContext, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ConversationHandler
 from datetime import datetime
 import asyncio
+import time
+
+import catalog
+import config
+import gallery
+import ingest
+import io_pool
+import persistence
+from ratelimit import OutboundRateLimiter
+from update_processor import PerUserUpdateProcessor
+from session import Action, History, PhotoGroup, PhotoType, Session
+import webhook
+import workers
+from debounce import Debouncer, Throttler
+
+TOKEN = 'YOUR TOKEN TELEGRAM'
 
 # Состояния для ConversationHandler
 CHOOSE_ACTION, CHOOSE_TYPE, CHOOSE_YEAR, CHOOSE_MODEL_NAME, CHOOSE_MONTH, SAVE_PHOTO, VIEW_PHOTOS = range(7)
@@ -18,6 +33,7 @@ EMOJIS = {
     'model': '👤',
     'landscape': '🏞️',
     'back': '◀️',
+    'next': '▶️',
     'done': '✅',
     'photo': '📷',
     'folder': '📁',
@@ -26,35 +42,14 @@ EMOJIS = {
     'error': '❌'
 }
 
-def get_available_years(user_id):
-    base_path = f"photos/user_{user_id}"
-    if not os.path.exists(base_path):
-        return []
-    return sorted([year for year in os.listdir(base_path)], reverse=True)
-
-def get_available_models(user_id, year):
-    path = f"photos/user_{user_id}/{year}/models"
-    if not os.path.exists(path):
-        return []
-    return sorted(os.listdir(path))
-
-def get_available_months(user_id, year):
-    path = f"photos/user_{user_id}/{year}/landscape"
-    if not os.path.exists(path):
-        return []
-    return sorted([int(month) for month in os.listdir(path)])
-
-def create_user_folders(user_id):
-    base_path = f"photos/user_{user_id}"
-    if not os.path.exists(base_path):
-        os.makedirs(base_path)
-
-def create_year_folders(user_id, year):
-    base_path = f"photos/user_{user_id}/{year}"
-    if not os.path.exists(base_path):
-        os.makedirs(base_path)
-        os.makedirs(os.path.join(base_path, "models"))
-        os.makedirs(os.path.join(base_path, "landscape"))
+months = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+          'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
+
+async def get_available_models(user_id, year):
+    return await io_pool.run(catalog.get_models, user_id, year)
+
+async def get_available_months(user_id, year):
+    return await io_pool.run(catalog.get_months, user_id, year)
 
 def is_valid_year(year_str):
     try:
@@ -72,13 +67,9 @@ def is_valid_month(month_str):
         return False
 
 def get_user_history(user_id, context):
-    if 'history' not in context.user_data:
-        context.user_data['history'] = {
-            'years': set(),
-            'models': set(),
-            'months': set()
-        }
-    return context.user_data['history']
+    if context.user_data.history is None:
+        context.user_data.history = History()
+    return context.user_data.history
 
 async def show_history_keyboard(update, context, item_type):
     user_id = update.effective_user.id
@@ -86,16 +77,13 @@ async def show_history_keyboard(update, context, item_type):
     
     keyboard = []
     if item_type == 'year':
-        for year in sorted(history['years'], reverse=True):
+        for year in sorted(history.years, reverse=True):
             keyboard.append([InlineKeyboardButton(f"{EMOJIS['calendar']} {year}", callback_data=f"year_{year}")])
     
     keyboard.append([InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back")])
     return InlineKeyboardMarkup(keyboard) if keyboard else None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    create_user_folders(user_id)
-    
     keyboard = [[
         InlineKeyboardButton(f"{EMOJIS['view']} Посмотреть фотографии", callback_data="action_view"),
         InlineKeyboardButton(f"{EMOJIS['add']} Добавить фотографии", callback_data="action_add")
@@ -116,7 +104,7 @@ async def action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await start(update, context)
         return CHOOSE_ACTION
         
-    context.user_data['action'] = action
+    context.user_data.action = Action.from_key(action)
     
     keyboard = [
         [
@@ -127,7 +115,7 @@ async def action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    if action == 'view':
+    if context.user_data.action == Action.VIEW:
         await query.edit_message_text(
             "Выберите тип фотографий для просмотра:",
             reply_markup=reply_markup
@@ -157,12 +145,12 @@ async def photo_type_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return CHOOSE_ACTION
 
-    context.user_data['photo_type'] = value
+    context.user_data.photo_type = PhotoType.from_key(value)
 
-    if context.user_data['action'] == 'view':
+    if context.user_data.action == Action.VIEW:
         # Логика для просмотра остается без изменений
         user_id = query.from_user.id
-        years = get_available_years(user_id)
+        years = await io_pool.run(catalog.get_nonempty_years, user_id, value)
         
         if not years:
             await query.edit_message_text(
@@ -173,12 +161,7 @@ async def photo_type_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         keyboard = []
         for year in years:
-            if value == 'model':
-                if get_available_models(user_id, year):
-                    keyboard.append([InlineKeyboardButton(f"{EMOJIS['calendar']} {year}", callback_data=f"year_{year}")])
-            else:
-                if get_available_months(user_id, year):
-                    keyboard.append([InlineKeyboardButton(f"{EMOJIS['calendar']} {year}", callback_data=f"year_{year}")])
+            keyboard.append([InlineKeyboardButton(f"{EMOJIS['calendar']} {year}", callback_data=f"year_{year}")])
         
         keyboard.append([InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="type_back")])
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -215,13 +198,12 @@ async def year_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return CHOOSE_YEAR
 
-    context.user_data['year'] = year_str
-    create_year_folders(update.effective_user.id, year_str)
+    context.user_data.year = int(year_str)
 
     keyboard = [[InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    if context.user_data['photo_type'] == 'model':
+    if context.user_data.photo_type == PhotoType.MODEL:
         await update.message.reply_text(
             f"{EMOJIS['model']} Введите имя модели:",
             reply_markup=reply_markup
@@ -251,22 +233,17 @@ async def model_name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
         if 'model_' in query.data:
             model_name = query.data.split('_')[1]
-            context.user_data['model_name'] = model_name
+            context.user_data.model_name = model_name
             return await view_photos(update, context)
     else:
         # Обработка текстового ввода имени модели
         model_name = update.message.text
-        context.user_data['model_name'] = model_name
-        
-        # Создаем папку для фотографий
-        path = f"photos/user_{update.effective_user.id}/{context.user_data['year']}/models/{model_name}"
-        if not os.path.exists(path):
-            os.makedirs(path)
+        context.user_data.model_name = model_name
         
         keyboard = [[InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
-            f"{EMOJIS['photo']} Отправьте фотографии модели {model_name} за {context.user_data['year']} год.",
+            f"{EMOJIS['photo']} Отправьте фотографии модели {model_name} за {context.user_data.year} год.",
             reply_markup=reply_markup
         )
         return SAVE_PHOTO
@@ -294,7 +271,7 @@ async def month_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
         if 'month_' in query.data:
             month = query.data.split('_')[1]
-            context.user_data['month'] = month
+            context.user_data.month = int(month)
             return await view_photos(update, context)
     else:
         month = update.message.text.lower()
@@ -309,16 +286,12 @@ async def month_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return CHOOSE_MONTH
         
         month = int(month)
-        context.user_data['month'] = str(month)
-        
-        path = f"photos/user_{update.effective_user.id}/{context.user_data['year']}/landscape/{month}"
-        if not os.path.exists(path):
-            os.makedirs(path)
+        context.user_data.month = month
         
         keyboard = [[InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
-            f"{EMOJIS['photo']} Отправьте пейзажные фотографии за {months[month-1]} {context.user_data['year']} года.",
+            f"{EMOJIS['photo']} Отправьте пейзажные фотографии за {months[month-1]} {context.user_data.year} года.",
             reply_markup=reply_markup
         )
         return SAVE_PHOTO
@@ -328,14 +301,14 @@ async def save_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [[InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        if context.user_data['photo_type'] == 'model':
+        if context.user_data.photo_type == PhotoType.MODEL:
             await update.message.reply_text(
                 f"{EMOJIS['model']} Введите имя модели:",
                 reply_markup=reply_markup
             )
         else:
             await update.message.reply_text(
-                f"{EMOJIS['photo']} Отправьте пейзажные фотографии за {months[int(context.user_data['month'])-1]} {context.user_data['year']} года.",
+                f"{EMOJIS['photo']} Отправьте пейзажные фотографии за {months[context.user_data.month-1]} {context.user_data.year} года.",
                 reply_markup=reply_markup
             )
         return SAVE_PHOTO
@@ -343,104 +316,269 @@ async def save_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     photo = update.message.photo[-1]
 
+    session = context.user_data
+    year, photo_type, category = str(session.year), session.photo_type.key, session.category
+    folder_key = await io_pool.run(catalog.category_key, user_id, year, photo_type, category)
+    target = ingest.UploadTarget(user_id, update.effective_chat.id, year, photo_type, category, folder_key)
+
+    # Фотографии альбома собираются по media_group_id и сохраняются одним пакетом
+    if update.message.media_group_id:
+        album_collector.add(update.message.media_group_id, context, target, photo)
+        return SAVE_PHOTO
+
     # Инициализация данных о группе фотографий
-    if 'photo_group' not in context.user_data:
-        context.user_data['photo_group'] = {
-            'saved_count': 0,
-            'status_message': None,
-            'last_photo_time': datetime.now(),
-            'user_id': user_id
-        }
-
-    if context.user_data['photo_type'] == 'model':
-        path = f"photos/user_{user_id}/{context.user_data['year']}/models/{context.user_data['model_name']}"
-    else:
-        path = f"photos/user_{user_id}/{context.user_data['year']}/landscape/{context.user_data['month']}"
+    if session.photo_group is None:
+        session.photo_group = PhotoGroup(user_id, update.effective_chat.id, time.time())
+    photo_group = session.photo_group
+
+    # Уже сохраненные фотографии не скачиваются повторно
+    duplicate = await ingest.check_duplicate(target, photo)
+    if duplicate:
+        photo_group.queued += 1
+        if duplicate == ingest.DUPLICATE_SKIPPED:
+            photo_group.skipped += 1
+        else:
+            photo_group.saved += 1
+        await update_status_message(update, context, photo_group)
+        completion_timer.trigger(user_id, context, update.effective_chat.id)
+        return SAVE_PHOTO
+
+    # Скачивание идет в фоновой очереди, обработчик только ставит задачу и подтверждает прием
+    try:
+        future = await download_queue.submit(context.bot, target, photo)
+    except ingest.DownloadQueueFull as e:
+        print(f"Очередь загрузки переполнена: {e}")
+        await update.message.reply_text("Сейчас загружается слишком много фотографий. Отправьте эту фотографию чуть позже.")
+        return SAVE_PHOTO
+
+    photo_group.queued += 1
+    photo_group.last_photo_time = time.time()
+    if photo_group.message_id is None:
+        await update_status_message(update, context, photo_group)
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    asyncio.create_task(photo_saved(context, update.effective_chat.id, photo_group, future))
+    return SAVE_PHOTO
+
+def get_status_text(photo_group):
+    status_text = f"Загружено фотографий: {photo_group.saved} из {photo_group.queued}"
+    if photo_group.skipped:
+        status_text += f"\nПропущено повторов: {photo_group.skipped}"
+    if photo_group.similar:
+        status_text += f"\nПохожи на уже сохраненные: {photo_group.similar}"
+    return status_text
+
+def get_summary_text(counts):
+    text = f"{EMOJIS['success']} Загружено фотографий: {counts['saved']}"
+    if counts['skipped']:
+        text += f"\nПропущено повторов: {counts['skipped']}"
+    if counts['similar']:
+        text += f"\nПохожи на уже сохраненные: {counts['similar']}"
+    if counts['failed']:
+        text += f"\n{EMOJIS['error']} Не удалось сохранить: {counts['failed']}. Попробуйте отправить их еще раз."
+    return text
+
+async def update_status_message(update, context, photo_group):
+    if photo_group.message_id is None:
+        status_text = get_status_text(photo_group)
+        message = await update.message.reply_text(status_text)
+        photo_group.message_id = message.message_id
+        shown_status[photo_group.user_id] = status_text
+        return
+    status_updater.trigger(photo_group.user_id, context, photo_group)
 
+async def edit_status_message(context, photo_group):
+    # Счетчики меняются после каждой фотографии, а сообщение изменяется не чаще
+    # раза в STATUS_UPDATE_INTERVAL и только если текст действительно другой
+    status_text = get_status_text(photo_group)
+    if photo_group.message_id is None or shown_status.get(photo_group.user_id) == status_text:
+        return
     try:
-        # Сохраняем фото
-        file = await context.bot.get_file(photo.file_id)
-        file_path = f"{path}/{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jpg"
-        await file.download_to_drive(file_path)
-        
-        context.user_data['photo_group']['saved_count'] += 1
-        saved_count = context.user_data['photo_group']['saved_count']
-        
-        # Обновляем статус
-        status_text = f"Загружено фотографий: {saved_count}"
-        
-        if context.user_data['photo_group']['status_message'] is None:
-            message = await update.message.reply_text(status_text)
-            context.user_data['photo_group']['status_message'] = message
-        else:
-            try:
-                await context.user_data['photo_group']['status_message'].edit_text(status_text)
-            except Exception as e:
-                print(f"Ошибка обновления статуса: {e}")
+        await context.bot.edit_message_text(status_text, chat_id=photo_group.chat_id, message_id=photo_group.message_id)
+        shown_status[photo_group.user_id] = status_text
+    except Exception as e:
+        print(f"Ошибка обновления статуса: {e}")
+
+# Последний показанный текст статуса по пользователю
+shown_status = {}
+status_updater = Throttler(config.STATUS_UPDATE_INTERVAL, edit_status_message)
 
-        # Запускаем таймер на проверку завершения
-        asyncio.create_task(delayed_completion_check(context, update.effective_chat.id))
+def session_changed(context, user_id):
+    # Сессию, измененную фоновой задачей, PTB сам не сохранит: к записи он отмечает
+    # только данные пользователей из обрабатываемых обновлений
+    context.application.mark_data_for_update_persistence(user_ids=user_id)
 
+async def photo_saved(context, chat_id, photo_group, future):
+    try:
+        result = await future
     except Exception as e:
         print(f"Ошибка при сохранении фото: {e}")
-        await update.message.reply_text("Произошла ошибка при сохранении фотографии. Попробуйте еще раз.")
-        return SAVE_PHOTO
+        await context.bot.send_message(chat_id, "Произошла ошибка при сохранении фотографии. Попробуйте еще раз.")
+        result = None
 
-    return SAVE_PHOTO
+    # Результат засчитывается группе, в которую фото попало при постановке в очередь.
+    # Группа могла быть сброшена через /cancel или «Готово», фото при этом все равно сохранено
+    if context.user_data.photo_group is not photo_group:
+        return
+
+    if result is None:
+        photo_group.failed += 1
+    elif result == ingest.DUPLICATE_SKIPPED:
+        photo_group.skipped += 1
+    else:
+        photo_group.saved += 1
+        if result == ingest.NEAR_DUPLICATE_FLAGGED:
+            photo_group.similar += 1
+    session_changed(context, photo_group.user_id)
+
+    if result is not None and photo_group.message_id is not None:
+        # Обновляем статус
+        status_updater.trigger(photo_group.user_id, context, photo_group)
+
+    # Перезапускаем таймер на проверку завершения: он сработает один раз после последнего фото
+    completion_timer.trigger(photo_group.user_id, context, chat_id)
 
 async def view_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if context.user_data['photo_type'] == 'model':
-        path = f"photos/user_{user_id}/{context.user_data['year']}/models/{context.user_data['model_name']}"
-    else:
-        path = f"photos/user_{user_id}/{context.user_data['year']}/landscape/{context.user_data['month']}"
-    
-    if not os.path.exists(path):
-        await update.message.reply_text("В вашей галерее пока нет фотографий в этой категории.")
-        return ConversationHandler.END
+    session = context.user_data
+    year, photo_type, category = str(session.year), session.photo_type.key, session.category
     
-    photos = [f for f in os.listdir(path) if f.endswith(('.jpg', '.jpeg', '.png'))]
+    photos = await io_pool.run(catalog.list_photos, user_id, year, photo_type, category)
     
     if not photos:
-        await update.message.reply_text("В вашей галерее пока нет фотографий в этой категории.")
+        await context.bot.send_message(
+            update.effective_chat.id,
+            "В вашей галерее пока нет фотографий в этой категории."
+        )
+        await context.bot.send_message(
+            update.effective_chat.id,
+            "Используйте /start для нового поиска."
+        )
+        return ConversationHandler.END
+
+    if config.GALLERY_MODE == 'carousel':
+        text = (f"Найдено {len(photos)} фотографий. Листайте кнопками {EMOJIS['back']} {EMOJIS['next']}\n"
+                "Используйте /start для нового поиска.")
     else:
-        if update.callback_query:
-            await update.callback_query.edit_message_text(f"Найдено {len(photos)} фотографий. Отправляю...")
-        else:
-            await update.message.reply_text(f"Найдено {len(photos)} фотографий. Отправляю...")
-            
-        for photo in photos:
-            with open(os.path.join(path, photo), 'rb') as f:
-                await context.bot.send_photo(update.effective_chat.id, photo=f)
-    
+        text = f"Найдено {len(photos)} фотографий. Отправляю..."
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text)
+    else:
+        await update.message.reply_text(text)
+
+    if config.GALLERY_MODE == 'carousel':
+        folder_key = await io_pool.run(catalog.category_key, user_id, year, photo_type, category)
+        await gallery.send_photo(
+            context.bot, update.effective_chat.id, folder_key, photos[0],
+            **get_carousel_markup(photos, photos[0].id)
+        )
+        # Соседние фотографии читаются в фоне: следующее нажатие пользователя не ждет prefetch
+        if len(photos) > 1:
+            context.application.create_task(gallery.prefetch(folder_key, [photos[1], photos[-1]]))
+        return ConversationHandler.END
+
+    await send_gallery_page(context, update.effective_chat.id, user_id, year, photo_type, category)
+    return ConversationHandler.END
+
+async def send_gallery_page(context, chat_id, user_id, year, photo_type, category, cursor=None):
+    photos = await io_pool.run(catalog.list_photos, user_id, year, photo_type, category)
+    page, start, prev_id, next_id = gallery.get_page(photos, cursor)
+    folder_key = await io_pool.run(catalog.category_key, user_id, year, photo_type, category)
+    await gallery.send_gallery(context.bot, chat_id, folder_key, page)
+
+    # Курсор страницы передается в callback_data, папка восстанавливается по id фотографии
+    buttons = []
+    if prev_id is not None:
+        buttons.append(InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data=f"page_{prev_id}"))
+    if next_id is not None:
+        buttons.append(InlineKeyboardButton(f"Ещё {EMOJIS['next']}", callback_data=f"page_{next_id}"))
+
+    text = f"{EMOJIS['photo']} Фотографии {start + 1}–{start + len(page)} из {len(photos)}"
+    if next_id is None:
+        text += "\n\nИспользуйте /start для нового поиска."
     await context.bot.send_message(
-        update.effective_chat.id,
-        "Используйте /start для нового поиска."
+        chat_id,
+        text,
+        reply_markup=InlineKeyboardMarkup([buttons]) if buttons else None
     )
-    return ConversationHandler.END
+
+def get_carousel_markup(photos, photo_id):
+    index, prev_photo, next_photo = gallery.get_neighbours(photos, photo_id)
+    markup = {'caption': f"{EMOJIS['photo']} {index + 1} из {len(photos)}"}
+    if len(photos) > 1:
+        markup['reply_markup'] = InlineKeyboardMarkup([[
+            InlineKeyboardButton(EMOJIS['back'], callback_data=f"slide_{prev_photo.id}"),
+            InlineKeyboardButton(EMOJIS['next'], callback_data=f"slide_{next_photo.id}")
+        ]])
+    return markup
+
+async def carousel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    photo_id = int(query.data.split('_')[1])
+    folder = await io_pool.run(catalog.find_photo, photo_id)
+    if folder is None or folder[0] != update.effective_user.id:
+        await query.edit_message_caption("Эта фотография больше недоступна. Используйте /start для нового поиска.")
+        return
+
+    user_id, year, photo_type, category = folder
+    photos = await io_pool.run(catalog.list_photos, user_id, year, photo_type, category)
+    index, prev_photo, next_photo = gallery.get_neighbours(photos, photo_id)
+    if index is None:
+        # Фотографии нет в закэшированном списке папки
+        await query.edit_message_caption("Эта фотография больше недоступна. Используйте /start для нового поиска.")
+        return
+    folder_key = await io_pool.run(catalog.category_key, user_id, year, photo_type, category)
+    await gallery.edit_photo(
+        context.bot, query.message.chat_id, query.message.message_id, folder_key, photos[index],
+        **get_carousel_markup(photos, photo_id)
+    )
+    context.application.create_task(gallery.prefetch(folder_key, [prev_photo, next_photo]))
+
+async def page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    photo_id = int(query.data.split('_')[1])
+    folder = await io_pool.run(catalog.find_photo, photo_id)
+    if folder is None or folder[0] != update.effective_user.id:
+        await query.edit_message_text("Эта страница галереи больше недоступна. Используйте /start для нового поиска.")
+        return
+
+    await query.edit_message_reply_markup(None)
+    user_id, year, photo_type, category = folder
+    await send_gallery_page(context, update.effective_chat.id, user_id, year, photo_type, category, cursor=photo_id)
 
 async def delayed_completion_check(context, chat_id):
-    await asyncio.sleep(3)
-    
-    if 'photo_group' not in context.user_data:
+    photo_group = context.user_data.photo_group
+    if photo_group is None:
         return
-        
-    try:
-        just_uploaded = context.user_data['photo_group']['saved_count']
-        
-        # Удаляем статусное сообщение
-        if context.user_data['photo_group']['status_message']:
-            await context.user_data['photo_group']['status_message'].delete()
-    except Exception as e:
-        print(f"Ошибка подсчета фотографий: {e}")
+
+    # Часть фотографий еще в очереди: таймер перезапустится, когда они скачаются
+    if photo_group.processed < photo_group.queued:
         return
 
-    # Сохраняем количество загруженных фотографий
-    context.user_data['just_uploaded'] = just_uploaded
+    # Группа отсоединяется до первого обращения к Telegram: фотографии, пришедшие
+    # пока отправляется итог, начинают новую группу и получат свой итог
+    context.user_data.photo_group = None
+    context.user_data.just_uploaded = photo_group.saved
+    session_changed(context, photo_group.user_id)
+    counts = {
+        'saved': photo_group.saved,
+        'failed': photo_group.failed,
+        'skipped': photo_group.skipped,
+        'similar': photo_group.similar,
+    }
+
+    # Удаляем статусное сообщение, отложенное обновление статуса уже не нужно
+    status_updater.cancel(photo_group.user_id)
+    shown_status.pop(photo_group.user_id, None)
+    if photo_group.message_id is not None:
+        try:
+            await context.bot.delete_message(photo_group.chat_id, photo_group.message_id)
+        except Exception as e:
+            print(f"Ошибка удаления статуса загрузки: {e}")
 
     # Отправляем итоговое сообщение
     keyboard = [[InlineKeyboardButton(f"{EMOJIS['done']} Готово", callback_data="done")]]
@@ -448,12 +586,26 @@ async def delayed_completion_check(context, chat_id):
     
     await context.bot.send_message(
         chat_id=chat_id,
-        text=f"{EMOJIS['success']} Загружено фотографий: {just_uploaded}",
+        text=get_summary_text(counts),
         reply_markup=reply_markup
     )
 
-    # Очищаем данные группы
-    del context.user_data['photo_group']
+completion_timer = Debouncer(config.COMPLETION_DELAY, delayed_completion_check)
+
+async def album_completed(context, target, counts):
+    context.user_data.just_uploaded = counts['saved']
+    session_changed(context, target.user_id)
+
+    keyboard = [[InlineKeyboardButton(f"{EMOJIS['done']} Готово", callback_data="done")]]
+    await context.bot.send_message(
+        chat_id=target.chat_id,
+        text=get_summary_text(counts),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+download_queue = ingest.DownloadQueue(config.DOWNLOAD_WORKERS, config.DOWNLOAD_QUEUE_SIZE,
+                                      config.DOWNLOAD_QUEUE_TIMEOUT, config.DOWNLOAD_METRICS_INTERVAL)
+album_collector = ingest.AlbumCollector(config.ALBUM_COLLECT_DELAY, download_queue, album_completed)
 
 async def done_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -461,13 +613,14 @@ async def done_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.effective_user.id
 
-    total_photos = get_total_user_photos(user_id)
+    total_photos = await get_total_user_photos(user_id)
     
-    # Очищаем все временные данные
-    if 'photo_group' in context.user_data:
-        del context.user_data['photo_group']
-    if 'just_uploaded' in context.user_data:
-        del context.user_data['just_uploaded']
+    # Очищаем все временные данные, статус загрузки при этом показывает итоговые значения
+    completion_timer.cancel(user_id)
+    context.user_data.photo_group = None
+    context.user_data.just_uploaded = None
+    await status_updater.finish(user_id)
+    shown_status.pop(user_id, None)
 
     await query.edit_message_text(
         f"{EMOJIS['success']} Загрузка завершена\n"
@@ -478,33 +631,16 @@ async def done_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    completion_timer.cancel(update.effective_user.id)
+    status_updater.cancel(update.effective_user.id)
+    shown_status.pop(update.effective_user.id, None)
+    album_collector.discard_user(update.effective_user.id)
+    context.user_data.photo_group = None
     await update.message.reply_text("Операция отменена. Используйте /start для начала работы.")
     return ConversationHandler.END
 
-def get_total_user_photos(user_id):
-    total = 0
-    base_path = f"photos/user_{user_id}"
-    
-    if not os.path.exists(base_path):
-        return total
-        
-    for year in os.listdir(base_path):
-        year_path = os.path.join(base_path, year)
-        # Подсчет фото моделей
-        models_path = os.path.join(year_path, "models")
-        if os.path.exists(models_path):
-            for model in os.listdir(models_path):
-                model_path = os.path.join(models_path, model)
-                total += len([f for f in os.listdir(model_path) if f.endswith(('.jpg', '.jpeg', '.png'))])
-        
-        # Подсчет пейзажных фото
-        landscape_path = os.path.join(year_path, "landscape")
-        if os.path.exists(landscape_path):
-            for month in os.listdir(landscape_path):
-                month_path = os.path.join(landscape_path, month)
-                total += len([f for f in os.listdir(month_path) if f.endswith(('.jpg', '.jpeg', '.png'))])
-    
-    return total
+async def get_total_user_photos(user_id):
+    return await io_pool.run(catalog.get_total_photos, user_id)
 
 async def handle_year_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -523,13 +659,13 @@ async def handle_year_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         return CHOOSE_TYPE
     
     year_str = query.data.split('_')[1]
-    context.user_data['year'] = year_str
+    context.user_data.year = int(year_str)
     
-    if context.user_data['action'] == 'view':
+    if context.user_data.action == Action.VIEW:
         user_id = query.from_user.id
-        if context.user_data['photo_type'] == 'model':
+        if context.user_data.photo_type == PhotoType.MODEL:
             # Показываем список моделей
-            models = get_available_models(user_id, year_str)
+            models = await get_available_models(user_id, year_str)
             keyboard = []
             for model in models:
                 keyboard.append([InlineKeyboardButton(f"{EMOJIS['model']} {model}", callback_data=f"model_{model}")])
@@ -539,7 +675,7 @@ async def handle_year_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             return CHOOSE_MODEL_NAME
         else:
             # Показываем список месяцев
-            available_months = get_available_months(user_id, year_str)
+            available_months = await get_available_months(user_id, year_str)
             keyboard = []
             for month in available_months:
                 keyboard.append([InlineKeyboardButton(f"{EMOJIS['calendar']} {months[month-1]}", callback_data=f"month_{month}")])
@@ -548,9 +684,59 @@ async def handle_year_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.edit_message_text(f"{EMOJIS['calendar']} Выберите месяц:", reply_markup=reply_markup)
             return CHOOSE_MONTH
 
-def main():
+def resume_uploads(application):
+    # Очередь скачивания после перезапуска пуста: недокачанные фото считаются неудачными,
+    # а итог восстановленной загрузки отправляется как обычно, по таймеру
+    for user_id, user_data in application.user_data.items():
+        photo_group = user_data.photo_group
+        if photo_group is None:
+            continue
+        photo_group.failed += photo_group.queued - photo_group.processed
+        application.mark_data_for_update_persistence(user_ids=user_id)
+        chat_id = photo_group.chat_id
+        completion_timer.trigger(user_id, CallbackContext(application, chat_id=chat_id, user_id=user_id), chat_id)
+
+async def on_startup(application):
+    if config.DEBUG_BLOCKING_MS > 0:
+        io_pool.report_blocking_calls(asyncio.get_running_loop(), config.DEBUG_BLOCKING_MS)
+    await download_queue.start()
+    resume_uploads(application)
+    application.persistence.start_eviction(application, config.SESSION_SWEEP_INTERVAL)
+
+async def on_stop(application):
+    # Приложение уже не принимает обновления, но бот и сессии еще работают: фотографии,
+    # прием которых подтвержден пользователю, докачиваются и попадают в итог загрузки
+    await download_queue.join(config.DRAIN_TIMEOUT)
+
+async def on_shutdown(application):
+    await download_queue.stop()
+    io_pool.shutdown()
+
+def application_builder():
+    builder = Application.builder().token(TOKEN)
+    if config.BOT_API_URL:
+        # Локальный сервер Bot API в режиме --local: файлы берутся прямо с его диска
+        builder = (
+            builder.base_url(f"{config.BOT_API_URL.rstrip('/')}/bot")
+            .base_file_url(f"{config.BOT_API_URL.rstrip('/')}/file/bot")
+            .local_mode(True)
+        )
+    return builder
+
+def build_application(shard=None):
     application = (
-        Application.builder().token('YOUR TOKEN TELEGRAM').build()
+        application_builder()
+        .context_types(ContextTypes(user_data=Session))
+        .concurrent_updates(PerUserUpdateProcessor(config.CONCURRENT_UPDATES))
+        # Общий лимит Telegram действует на бота целиком, поэтому делится между воркерами
+        .rate_limiter(OutboundRateLimiter(config.RATE_LIMIT_GLOBAL / config.WORKERS, config.RATE_LIMIT_CHAT,
+                                          config.RATE_LIMIT_GROUP))
+        .persistence(persistence.SQLitePersistence(config.PERSISTENCE_PATH, config.PERSISTENCE_INTERVAL,
+                                                   config.SESSION_TTL, config.MAX_SESSIONS, shard))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
     )
     
     conv_handler = ConversationHandler(
@@ -579,13 +765,29 @@ def main():
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_chat=True,
-        name="photo_bot_conversation"
+        name="photo_bot_conversation",
+        persistent=True
     )
     
+    # Листание галереи работает и после завершения диалога, поэтому обработчик стоит перед ним
+    application.add_handler(CallbackQueryHandler(page_handler, pattern=r"^page_\d+$"))
+    application.add_handler(CallbackQueryHandler(carousel_handler, pattern=r"^slide_\d+$"))
     application.add_handler(conv_handler)
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    return application
+
+def main():
+    catalog.init_catalog()
+
+    # В режиме нескольких процессов этот процесс только получает обновления и раздает их воркерам
+    if config.WORKERS > 1:
+        application = workers.build_dispatcher(application_builder(), config.WORKERS)
+    else:
+        application = build_application()
+
+    if config.TRANSPORT == 'webhook':
+        webhook.run(application)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
-    months = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-              'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
     main()    
\ No newline at end of file
@@ -0,0 +1,317 @@
+import asyncio
+import json
+import pickle
+import random
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from enum import Enum
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import io_pool
+from session import Session
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+# По скольким сессиям оценивать память в отчете: обход всех сессий занимал бы
+# цикл событий на время, пропорциональное их числу
+MEMORY_REPORT_SAMPLE = 200
+
+# Колонки, добавленные после первой версии схемы
+USER_DATA_COLUMNS = {
+    'updated_at': 'REAL NOT NULL DEFAULT 0',
+}
+
+
+def dump(obj):
+    # Компактный двоичный формат записи: pickle последней версии, сжатый zlib
+    return zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def load(data):
+    return pickle.loads(zlib.decompress(data))
+
+
+def load_session(data):
+    session = load(data)
+    if isinstance(session, dict):
+        session = Session.from_dict(session)
+    return session
+
+
+def deep_sizeof(obj, seen=None):
+    # Приблизительный объем объекта в памяти вместе со всем, на что он ссылается
+    if seen is None:
+        seen = set()
+    # Члены перечислений общие для всех сессий и в объем сессии не входят
+    if id(obj) in seen or isinstance(obj, Enum):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(vars(obj), seen)
+        for name in getattr(type(obj), '__slots__', ()):
+            if name != '_bot' and hasattr(obj, name):
+                size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+
+class SQLitePersistence(BasePersistence):
+    # Хранит user_data и состояния ConversationHandler в SQLite. Application передает
+    # изменения раз в update_interval секунд, а они копятся в памяти и пишутся
+    # в базу одной транзакцией в пуле потоков io_pool.
+    # В памяти держатся только недавние сессии: простаивающие дольше session_ttl
+    # и лишние сверх max_sessions выгружаются в базу и подгружаются обратно,
+    # когда пользователь снова пишет боту.
+    # shard = (номер, всего) для воркера в режиме нескольких процессов: при старте
+    # поднимаются только сессии пользователей этого воркера
+
+    def __init__(self, path, update_interval=60, session_ttl=1800, max_sessions=10000, shard=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.shard = shard or (0, 1)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pending = {}
+        self._write_task = None
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        # user_id -> (время последнего обращения, user_data), от давних к недавним
+        self._resident = OrderedDict()
+        self._evicted = set()
+        self._eviction_task = None
+
+    def _connect(self):
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute("PRAGMA synchronous=NORMAL")
+                self._connection.executescript(SCHEMA)
+                existing = {row[1] for row in self._connection.execute("PRAGMA table_info(user_data)")}
+                for name, column_type in USER_DATA_COLUMNS.items():
+                    if name not in existing:
+                        self._connection.execute(f"ALTER TABLE user_data ADD COLUMN {name} {column_type}")
+            return self._connection
+
+    def _read_user_data(self, since, limit):
+        conn = self._connect()
+        index, count = self.shard
+        with self._lock:
+            rows = conn.execute(
+                "SELECT user_id, data, updated_at FROM user_data WHERE updated_at >= ? AND user_id % ? = ? "
+                "ORDER BY updated_at DESC LIMIT ?",
+                (since, count, index, limit),
+            ).fetchall()
+        return [(user_id, load_session(data), updated_at) for user_id, data, updated_at in reversed(rows)]
+
+    def _read_session(self, user_id):
+        conn = self._connect()
+        with self._lock:
+            row = conn.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return load_session(row[0]) if row else None
+
+    def _read_conversations(self, name):
+        conn = self._connect()
+        with self._lock:
+            rows = conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        index, count = self.shard
+        conversations = {}
+        for key, state in rows:
+            key = tuple(json.loads(key))
+            # Ключ диалога - (chat_id, user_id), воркер выбирается по пользователю
+            if abs(key[-1]) % count == index:
+                conversations[key] = load(state)
+        return conversations
+
+    def _write_rows(self, rows):
+        conn = self._connect()
+        now = time.time()
+        with self._lock, conn:
+            for (table, key), data in rows:
+                if table == 'user':
+                    if data is None:
+                        conn.execute("DELETE FROM user_data WHERE user_id = ?", (key,))
+                    else:
+                        conn.execute(
+                            "INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) "
+                            "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, "
+                            "updated_at = excluded.updated_at",
+                            (key, data, now),
+                        )
+                else:
+                    name, conversation_key = key
+                    if data is None:
+                        conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?",
+                                     (name, conversation_key))
+                    else:
+                        conn.execute(
+                            "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                            "ON CONFLICT (name, key) DO UPDATE SET state = excluded.state",
+                            (name, conversation_key, data),
+                        )
+
+    def _schedule_write(self, entry, data):
+        # Последнее значение записи вытесняет предыдущее, пока пакет еще не записан
+        self._pending[entry] = data
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # Даем Application передать остальные изменения этого прохода, чтобы записать их вместе
+        await asyncio.sleep(0)
+        while self._pending:
+            pending, self._pending = self._pending, {}
+            rows = [(entry, None if data is None else dump(data)) for entry, data in pending.items()]
+            try:
+                await io_pool.run(self._write_rows, rows)
+            except Exception as e:
+                print(f"Ошибка записи сессий: {e}")
+
+    async def get_user_data(self):
+        # При старте поднимаются только сессии, активные в пределах session_ttl,
+        # остальные загружаются по первому обращению в refresh_user_data
+        sessions = await io_pool.run(self._read_user_data, time.time() - self.session_ttl, self.max_sessions)
+        user_data = {}
+        for user_id, data, updated_at in sessions:
+            user_data[user_id] = data
+            self._resident[user_id] = (updated_at, data)
+        return user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await io_pool.run(self._read_conversations, name)
+
+    async def update_user_data(self, user_id, data):
+        self._schedule_write(('user', user_id), data)
+
+    async def update_conversation(self, name, key, new_state):
+        self._schedule_write(('conversation', (name, json.dumps(list(key)))), new_state)
+
+    async def drop_user_data(self, user_id):
+        # Выгруженная сессия удаляется только из памяти. Если пользователь успел вернуться,
+        # пока Application обрабатывал выгрузку, записываем его текущие данные
+        if user_id in self._evicted:
+            self._evicted.discard(user_id)
+            if user_id in self._resident:
+                self._schedule_write(('user', user_id), self._resident[user_id][1])
+            return
+        self._resident.pop(user_id, None)
+        self._schedule_write(('user', user_id), None)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id not in self._resident:
+            data = await io_pool.run(self._read_session, user_id)
+            if data is not None:
+                user_data.copy_from(data)
+        self._resident.pop(user_id, None)
+        self._resident[user_id] = (time.time(), user_data)
+
+    def evict_idle(self, application):
+        # Сессию с незавершенной загрузкой не трогаем: ее счетчики еще обновляют фоновые задачи
+        deadline = time.time() - self.session_ttl
+        overflow = len(self._resident) - self.max_sessions
+        evicted = 0
+        for user_id, (last_seen, user_data) in list(self._resident.items()):
+            if last_seen >= deadline and evicted >= overflow:
+                break
+            if user_data.photo_group is not None:
+                continue
+            del self._resident[user_id]
+            self._evicted.add(user_id)
+            self._schedule_write(('user', user_id), user_data)
+            application.drop_user_data(user_id)
+            evicted += 1
+        return evicted
+
+    def memory_report(self, sample_size=MEMORY_REPORT_SAMPLE):
+        # Объем считается по случайной выборке сессий, общий - пересчетом на все сессии
+        sessions = [user_data for _, user_data in self._resident.values()]
+        sample = random.sample(sessions, min(sample_size, len(sessions)))
+        sizes = [deep_sizeof(user_data) for user_data in sample]
+        avg = sum(sizes) // len(sizes) if sizes else 0
+        return {
+            'sessions': len(sessions),
+            'sampled': len(sizes),
+            'total_bytes': avg * len(sessions),
+            'avg_bytes': avg,
+            'max_bytes': max(sizes, default=0),
+        }
+
+    def start_eviction(self, application, interval):
+        self._eviction_task = asyncio.create_task(self._evict_periodically(application, interval))
+
+    async def stop_eviction(self):
+        if self._eviction_task is not None:
+            self._eviction_task.cancel()
+            await asyncio.gather(self._eviction_task, return_exceptions=True)
+            self._eviction_task = None
+
+    async def _evict_periodically(self, application, interval):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle(application)
+            report = self.memory_report()
+            print(f"Сессии: в памяти {report['sessions']}, выгружено {evicted}, "
+                  f"занято около {report['total_bytes']} байт, в среднем {report['avg_bytes']} байт на сессию, "
+                  f"максимум {report['max_bytes']} байт (по выборке из {report['sampled']})")
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await self.stop_eviction()
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
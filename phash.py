@@ -0,0 +1,139 @@
+import sys
+from io import BytesIO
+
+import catalog
+import io_pool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Размер разностного хэша: 9x8 пикселей дают 64 бита
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+
+# Сколько деревьев пользователей держать в памяти
+TREE_CACHE_SIZE = 1024
+
+_trees = {}
+
+
+def compute_dhash(data):
+    # dHash: уменьшенное серое изображение, бит на каждую пару соседних пикселей.
+    # data - содержимое файла или путь к нему. Без Pillow поиск похожих фотографий отключен
+    if Image is None:
+        return None
+    try:
+        with Image.open(data if isinstance(data, str) else BytesIO(data)) as image:
+            pixels = list(image.convert('L').resize((HASH_WIDTH, HASH_HEIGHT), Image.LANCZOS).getdata())
+    except OSError as e:
+        print(f"Не удалось посчитать хэш изображения: {e}")
+        return None
+
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for column in range(HASH_WIDTH - 1):
+            left = pixels[row * HASH_WIDTH + column]
+            right = pixels[row * HASH_WIDTH + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    # BK-дерево по расстоянию Хэмминга: поиск обходит только ветви, в которых
+    # по неравенству треугольника может найтись хэш не дальше max_distance
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_value, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                found.append((distance, node_value))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found)
+
+
+def build_tree(user_id):
+    tree = BKTree()
+    for value in catalog.get_dhashes(user_id):
+        tree.add(value)
+    return tree
+
+
+async def get_tree(user_id):
+    # Дерево строится из каталога в пуле потоков, а обновляется и читается только в цикле событий
+    tree = _trees.pop(user_id, None)
+    if tree is None:
+        tree = await io_pool.run(build_tree, user_id)
+        tree = _trees.pop(user_id, tree)
+    _trees[user_id] = tree
+    if len(_trees) > TREE_CACHE_SIZE:
+        del _trees[next(iter(_trees))]
+    return tree
+
+
+async def find_similar(user_id, value, max_distance):
+    return (await get_tree(user_id)).search(value, max_distance)
+
+
+def remember(user_id, value):
+    if user_id in _trees:
+        _trees[user_id].add(value)
+
+
+def index_existing():
+    # Считает хэши для фотографий, сохраненных до появления поиска похожих
+    indexed = 0
+    for photo_id, path in catalog.photos_without_dhash():
+        try:
+            with open(path, 'rb') as f:
+                value = compute_dhash(f.read())
+        except OSError as e:
+            print(f"Не удалось прочитать {path}: {e}")
+            continue
+        if value is not None:
+            catalog.set_dhash(photo_id, value)
+            indexed += 1
+    return indexed
+
+
+if __name__ == '__main__':
+    # python phash.py index - посчитать хэши для уже сохраненных фотографий
+    if Image is None:
+        print("Для поиска похожих фотографий нужен Pillow: pip install Pillow")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'index':
+        catalog.init_catalog()
+        print(f"Проиндексировано фотографий: {index_existing()}")
+    else:
+        print("Использование: python phash.py index")
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Приоритет запроса, передается через rate_limit_args методов бота.
+# Ответы пользователю идут раньше массовой отправки галереи
+INTERACTIVE = 0
+BULK = 1
+
+# Сколько ведер чатов держать, прежде чем убирать заполненные (давно не использованные)
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    # Ведро на capacity запросов, пополняется со скоростью rate запросов в секунду
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    # Общий ограничитель для всех исходящих запросов бота: overall_rate сообщений
+    # в секунду на бота, chat_rate в секунду на чат и group_rate в минуту на группу.
+    # Ограничиваются только запросы с chat_id - отправка и изменение сообщений.
+    # RetryAfter от Telegram приостанавливает все запросы на указанное время,
+    # после чего запрос встает в очередь заново, а не падает с ошибкой
+
+    def __init__(self, overall_rate=30, chat_rate=1, group_rate=20, max_retries=3):
+        self.overall_rate = overall_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._overall = TokenBucket(overall_rate, max(overall_rate, 1))
+        self._chats = {}
+        self._groups = {}
+        self._paused_until = 0
+        # Очередь запросов в каждый чат: chat_id -> [замок, сколько запросов ее ждут]
+        self._chat_queues = {}
+        # Интерактивные запросы, которые ждут только общего лимита
+        self._interactive_waiting = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _buckets(self, chat_id, now):
+        if len(self._chats) > MAX_CHAT_BUCKETS:
+            for buckets in (self._chats, self._groups):
+                for key in [key for key, bucket in buckets.items() if bucket.is_full(now)]:
+                    del buckets[key]
+        buckets = []
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        buckets.append(bucket)
+        # У групп и каналов отрицательные id или @username
+        if isinstance(chat_id, str) or chat_id < 0:
+            bucket = self._groups.get(chat_id)
+            if bucket is None:
+                bucket = self._groups[chat_id] = TokenBucket(self.group_rate / 60, self.group_rate)
+            buckets.append(bucket)
+        return buckets
+
+    async def _acquire(self, chat_id, priority):
+        competing = False
+        try:
+            while True:
+                now = time.monotonic()
+                chat_buckets = self._buckets(chat_id, now)
+                wait = max([self._paused_until - now] + [bucket.wait_time(now) for bucket in chat_buckets])
+                if wait <= 0:
+                    if priority == INTERACTIVE and not competing:
+                        competing = True
+                        self._interactive_waiting += 1
+                    wait = self._overall.wait_time(now)
+                    # Массовые запросы уступают общий лимит ждущим интерактивным
+                    if priority != INTERACTIVE and self._interactive_waiting:
+                        wait = max(wait, 1 / self.overall_rate)
+                    if wait <= 0:
+                        self._overall.take(now)
+                        for bucket in chat_buckets:
+                            bucket.take(now)
+                        return
+                await asyncio.sleep(wait)
+        finally:
+            if competing:
+                self._interactive_waiting -= 1
+
+    async def _acquire_in_order(self, chat_id, priority):
+        # Сообщения в один чат получают разрешение в порядке поступления
+        entry = self._chat_queues.get(chat_id)
+        if entry is None:
+            entry = self._chat_queues[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._acquire(chat_id, priority)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_queues[chat_id]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        priority = BULK if rate_limit_args == BULK else INTERACTIVE
+        attempt = 0
+        while True:
+            await self._acquire_in_order(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                print(f"Telegram просит подождать {retry_after} с перед {endpoint}, запрос будет повторен")
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
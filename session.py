@@ -0,0 +1,149 @@
+from enum import IntEnum
+
+
+class Action(IntEnum):
+    VIEW = 1
+    ADD = 2
+
+    @property
+    def key(self):
+        return self.name.lower()
+
+    @classmethod
+    def from_key(cls, key):
+        return cls[key.upper()]
+
+
+class PhotoType(IntEnum):
+    MODEL = 1
+    LANDSCAPE = 2
+
+    @property
+    def key(self):
+        # Строковое имя типа используется в путях папок и в callback_data
+        return self.name.lower()
+
+    @classmethod
+    def from_key(cls, key):
+        return cls[key.upper()]
+
+
+class SlotsState:
+    # Состояние хранится кортежем значений полей: так копирование и pickle
+    # при записи сессий дешевле, чем для словаря с именами ключей
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class History(SlotsState):
+    __slots__ = ('years', 'models', 'months')
+
+    def __init__(self):
+        self.years = set()
+        self.models = set()
+        self.months = set()
+
+
+class PhotoGroup(SlotsState):
+    # Счетчики текущей загрузки. От статусного сообщения хранятся только
+    # chat_id и message_id - этого хватает, чтобы его изменить или удалить
+    __slots__ = ('user_id', 'chat_id', 'message_id', 'saved', 'failed', 'skipped', 'similar',
+                 'queued', 'last_photo_time')
+
+    def __init__(self, user_id, chat_id, last_photo_time):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = None
+        self.saved = 0
+        self.failed = 0
+        self.skipped = 0
+        self.similar = 0
+        self.queued = 0
+        self.last_photo_time = last_photo_time
+
+    @property
+    def processed(self):
+        return self.saved + self.failed + self.skipped
+
+
+class Session(SlotsState):
+    # Данные пользователя в context.user_data (см. ContextTypes в main)
+    __slots__ = ('action', 'photo_type', 'year', 'model_name', 'month', 'photo_group',
+                 'just_uploaded', 'history')
+
+    def __init__(self):
+        self.action = None
+        self.photo_type = None
+        self.year = None
+        self.model_name = None
+        self.month = None
+        self.photo_group = None
+        self.just_uploaded = None
+        self.history = None
+
+    def __getstate__(self):
+        # Перечисления сохраняются как числа, чтобы не писать в каждую запись ссылку на класс
+        state = list(super().__getstate__())
+        state[0] = None if self.action is None else int(self.action)
+        state[1] = None if self.photo_type is None else int(self.photo_type)
+        return tuple(state)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self.action is not None:
+            self.action = Action(self.action)
+        if self.photo_type is not None:
+            self.photo_type = PhotoType(self.photo_type)
+
+    def copy_from(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(other, name))
+
+    @property
+    def category(self):
+        if self.photo_type == PhotoType.MODEL:
+            return self.model_name
+        return str(self.month)
+
+    @classmethod
+    def from_dict(cls, data):
+        # Сессии, сохраненные до перехода на Session, были словарями
+        session = cls()
+        if data.get('action'):
+            session.action = Action.from_key(data['action'])
+        if data.get('photo_type'):
+            session.photo_type = PhotoType.from_key(data['photo_type'])
+        if data.get('year'):
+            session.year = int(data['year'])
+        session.model_name = data.get('model_name')
+        if data.get('month'):
+            session.month = int(data['month'])
+        session.just_uploaded = data.get('just_uploaded')
+        if data.get('history'):
+            session.history = History()
+            session.history.years = set(data['history'].get('years', ()))
+            session.history.models = set(data['history'].get('models', ()))
+            session.history.months = set(data['history'].get('months', ()))
+        group = data.get('photo_group')
+        if group:
+            message = group.get('status_message')
+            session.photo_group = PhotoGroup(group['user_id'], message.chat_id if message else None,
+                                             group['last_photo_time'].timestamp())
+            session.photo_group.message_id = message.message_id if message else None
+            session.photo_group.saved = group['saved_count']
+            session.photo_group.failed = group['failed_count']
+            session.photo_group.skipped = group['skipped_count']
+            session.photo_group.similar = group['similar_count']
+            session.photo_group.queued = group['queued_count']
+        return session
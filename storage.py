@@ -0,0 +1,230 @@
+import os
+import shutil
+import threading
+
+import config
+import io_pool
+
+try:
+    import boto3
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
+
+# Размер блока при потоковом чтении
+CHUNK_SIZE = 256 * 1024
+
+# Ошибки чтения отдельного ключа: файла нет на диске, объекта нет в бакете или хранилище недоступно
+READ_ERRORS = (OSError,) if boto3 is None else (OSError, BotoCoreError, ClientError)
+
+
+class StorageBackend:
+    # Хранилище фотографий. Ключ - относительный путь через '/', например
+    # user_5/2021/models/Anna/20210101_120000_000000_x.jpg или objects/ab/cd/<sha256>
+
+    # Дешевы ли ссылки между ключами. Если нет, запись в папке - это только строка
+    # каталога, а содержимое читается по ключу блоба
+    supports_links = False
+
+    async def put(self, key, data):
+        raise NotImplementedError
+
+    def get_stream(self, key):
+        # Асинхронный итератор по частям содержимого
+        raise NotImplementedError
+
+    async def list(self, prefix):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def exists(self, key):
+        raise NotImplementedError
+
+    async def link(self, source_key, key):
+        await self.put(key, await self.read(source_key))
+
+    async def put_file(self, key, path):
+        # Кладет в хранилище готовый локальный файл (например, из локального сервера Bot API)
+        await self.put(key, await io_pool.run(_read_file, path))
+
+    async def read(self, key):
+        return b''.join([chunk async for chunk in self.get_stream(key)])
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class LocalStorage(StorageBackend):
+    supports_links = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    async def put(self, key, data):
+        await io_pool.run(self._write, self.path(key), data)
+
+    @staticmethod
+    def _write(path, data):
+        # Запись через временный файл: читатели не увидят недописанную фотографию
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Имя временного файла уникально для потока и процесса: один и тот же блоб
+        # могут одновременно записывать несколько воркеров
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    async def get_stream(self, key):
+        f = await io_pool.run(open, self.path(key), 'rb')
+        try:
+            while True:
+                chunk = await io_pool.run(f.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    async def list(self, prefix):
+        return await io_pool.run(self._list, prefix)
+
+    def _list(self, prefix):
+        base = self.path(prefix)
+        keys = []
+        for root, dirs, files in os.walk(base):
+            for name in files:
+                relative = os.path.relpath(os.path.join(root, name), self.root)
+                keys.append(relative.replace(os.sep, '/'))
+        return sorted(keys)
+
+    async def delete(self, key):
+        try:
+            await io_pool.run(os.remove, self.path(key))
+        except FileNotFoundError:
+            pass
+
+    async def exists(self, key):
+        return await io_pool.run(os.path.exists, self.path(key))
+
+    async def link(self, source_key, key):
+        await io_pool.run(self._link, self.path(source_key), self.path(key))
+
+    @staticmethod
+    def _link(source, destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.link(source, destination)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    async def put_file(self, key, path):
+        await io_pool.run(self._put_file, path, self.path(key))
+
+    @staticmethod
+    def _put_file(source, destination):
+        # Жесткая ссылка не копирует данные. Если файл на другой файловой системе
+        # или ссылку сделать нельзя, он копируется потоково через временный файл
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.link(source, destination)
+            return
+        except FileExistsError:
+            return
+        except OSError:
+            pass
+        temp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.part"
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, destination)
+
+
+class S3Storage(StorageBackend):
+    # S3-совместимое хранилище (AWS, MinIO). Клиент boto3 синхронный,
+    # поэтому каждый запрос выполняется в пуле потоков io_pool
+
+    def __init__(self, bucket, endpoint_url=None, access_key=None, secret_key=None, region=None):
+        if boto3 is None:
+            raise RuntimeError("Для хранилища S3 нужен boto3: pip install boto3")
+        self.bucket = bucket
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name=region
+        )
+
+    async def put(self, key, data):
+        await io_pool.run(self.client.put_object, Bucket=self.bucket, Key=key, Body=bytes(data))
+
+    async def put_file(self, key, path):
+        # upload_file читает файл частями и не держит его в памяти целиком
+        await io_pool.run(self.client.upload_file, path, self.bucket, key)
+
+    async def get_stream(self, key):
+        response = await io_pool.run(self.client.get_object, Bucket=self.bucket, Key=key)
+        body = response['Body']
+        try:
+            while True:
+                chunk = await io_pool.run(body.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    async def list(self, prefix):
+        return await io_pool.run(self._list, prefix)
+
+    def _list(self, prefix):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix.rstrip('/') + '/'):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+        return sorted(keys)
+
+    async def delete(self, key):
+        await io_pool.run(self.client.delete_object, Bucket=self.bucket, Key=key)
+
+    async def exists(self, key):
+        try:
+            await io_pool.run(self.client.head_object, Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    async def link(self, source_key, key):
+        # Копирование на стороне сервера, байты через бота не проходят
+        await io_pool.run(
+            self.client.copy_object,
+            Bucket=self.bucket, Key=key, CopySource={'Bucket': self.bucket, 'Key': source_key}
+        )
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if config.STORAGE_BACKEND == 's3':
+            _backend = S3Storage(
+                config.S3_BUCKET,
+                endpoint_url=config.S3_ENDPOINT_URL,
+                access_key=config.S3_ACCESS_KEY,
+                secret_key=config.S3_SECRET_KEY,
+                region=config.S3_REGION
+            )
+        else:
+            _backend = LocalStorage(config.PHOTOS_DIR)
+    return _backend
@@ -0,0 +1,190 @@
+import asyncio
+import random
+import unittest
+from unittest import mock
+
+from telegram import Update
+
+import ingest
+import main
+from debounce import Debouncer, Throttler
+from session import Action, PhotoType, Session
+from update_processor import PerUserUpdateProcessor
+
+USERS = (101, 202, 303, 404)
+PHOTOS_PER_USER = 30
+
+
+class FakeBot:
+    # Отвечает на запросы как Telegram, ничего не отправляя
+
+    def __init__(self):
+        self.status_messages = {}
+        self.errors = []
+        self._message_id = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(random.random() / 1000)
+        self._message_id += 1
+        if text.startswith("Загружено фотографий"):
+            self.status_messages[chat_id] = self.status_messages.get(chat_id, 0) + 1
+        else:
+            self.errors.append((chat_id, text))
+        return Update.de_json({'update_id': 0, 'message': {
+            'message_id': self._message_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': text,
+        }}, self).message
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(random.random() / 1000)
+
+
+class FakeDownloadQueue:
+    # Скачивание завершается через случайное время, поэтому результаты приходят
+    # вперемешку и позже, чем следующие фотографии того же пользователя
+
+    def __init__(self):
+        self.submitted = []
+
+    async def submit(self, bot, target, photo):
+        await asyncio.sleep(random.random() / 1000)
+        self.submitted.append((target.user_id, photo.file_id))
+        future = asyncio.get_running_loop().create_future()
+        number = int(photo.file_id.rsplit('_', 1)[1])
+        if number % 10 == 0:
+            result = OSError("скачивание не удалось")
+        elif number % 7 == 0:
+            result = ingest.DUPLICATE_SKIPPED
+        else:
+            result = ingest.PHOTO_SAVED
+        asyncio.get_running_loop().call_later(random.random() / 50, self._resolve, future, result)
+        return future
+
+    @staticmethod
+    def _resolve(future, result):
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+async def no_duplicate(target, photo):
+    await asyncio.sleep(random.random() / 1000)
+    return None
+
+
+def photo_update(bot, user_id, number):
+    # Отдельная фотография без media_group_id: она попадает в photo_group сессии
+    return Update.de_json({
+        'update_id': user_id * 1000 + number,
+        'message': {
+            'message_id': number,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'},
+            'photo': [{'file_id': f"photo_{user_id}_{number}", 'file_unique_id': f"unique_{user_id}_{number}",
+                       'width': 100, 'height': 100}],
+        },
+    }, bot)
+
+
+def upload_session():
+    session = Session()
+    session.action = Action.ADD
+    session.photo_type = PhotoType.LANDSCAPE
+    session.year = 2024
+    session.month = 5
+    return session
+
+
+class PerUserUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        random.seed(22)
+        self.processor = PerUserUpdateProcessor(8)
+        await self.processor.initialize()
+        # Итог загрузки не отправляется, пока тест не проверит счетчики
+        self.completion_timer = Debouncer(3600, main.delayed_completion_check)
+        self.status_updater = Throttler(0.005, main.edit_status_message)
+        patches = [
+            mock.patch.object(main, 'download_queue', FakeDownloadQueue()),
+            mock.patch.object(main, 'completion_timer', self.completion_timer),
+            mock.patch.object(main, 'status_updater', self.status_updater),
+            mock.patch.object(main.catalog, 'category_key', lambda *args: 'folder'),
+            mock.patch.object(main.ingest, 'check_duplicate', no_duplicate),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def asyncTearDown(self):
+        for user_id in USERS:
+            self.completion_timer.cancel(user_id)
+            self.status_updater.cancel(user_id)
+        main.shown_status.clear()
+
+    async def run_interleaved(self, updates, handler):
+        # Обновления всех пользователей поступают вперемешку, как из getUpdates
+        await asyncio.gather(*[
+            self.processor.process_update(update, handler(update)) for update in updates
+        ])
+
+    async def test_updates_of_one_user_run_in_order_and_users_in_parallel(self):
+        bot = FakeBot()
+        updates = [photo_update(bot, user_id, number)
+                   for number in range(1, PHOTOS_PER_USER + 1) for user_id in USERS]
+        seen = {user_id: [] for user_id in USERS}
+        running = {user_id: 0 for user_id in USERS}
+        overlap = {'max_users': 0, 'max_per_user': 0}
+
+        async def handler(update):
+            user_id = update.effective_user.id
+            running[user_id] += 1
+            overlap['max_per_user'] = max(overlap['max_per_user'], running[user_id])
+            overlap['max_users'] = max(overlap['max_users'], sum(1 for count in running.values() if count))
+            seen[user_id].append(update.message.message_id)
+            await asyncio.sleep(random.random() / 1000)
+            running[user_id] -= 1
+
+        await self.run_interleaved(updates, handler)
+
+        for user_id in USERS:
+            self.assertEqual(seen[user_id], list(range(1, PHOTOS_PER_USER + 1)))
+        self.assertEqual(overlap['max_per_user'], 1)
+        self.assertGreater(overlap['max_users'], 1)
+
+    async def test_photo_group_counters_stay_consistent(self):
+        bot = FakeBot()
+        contexts = {user_id: mock.Mock(bot=bot, user_data=upload_session()) for user_id in USERS}
+        updates = [photo_update(bot, user_id, number)
+                   for number in range(1, PHOTOS_PER_USER + 1) for user_id in USERS]
+
+        async def handler(update):
+            return await main.save_photo(update, contexts[update.effective_user.id])
+
+        await self.run_interleaved(updates, handler)
+        # Дожидаемся фоновых photo_saved: все скачивания завершаются за доли секунды
+        for _ in range(100):
+            if all(context.user_data.photo_group.processed == PHOTOS_PER_USER for context in contexts.values()):
+                break
+            await asyncio.sleep(0.01)
+
+        numbers = range(1, PHOTOS_PER_USER + 1)
+        failed = sum(1 for number in numbers if number % 10 == 0)
+        skipped = sum(1 for number in numbers if number % 10 and number % 7 == 0)
+        for user_id, context in contexts.items():
+            photo_group = context.user_data.photo_group
+            self.assertIsNotNone(photo_group)
+            self.assertEqual(photo_group.user_id, user_id)
+            self.assertEqual(photo_group.queued, PHOTOS_PER_USER)
+            self.assertEqual(photo_group.failed, failed)
+            self.assertEqual(photo_group.skipped, skipped)
+            self.assertEqual(photo_group.saved, PHOTOS_PER_USER - failed - skipped)
+            # Одна группа на загрузку - одно статусное сообщение
+            self.assertEqual(bot.status_messages[user_id], 1)
+            self.assertTrue(self.completion_timer.pending(user_id))
+        self.assertEqual(len(main.download_queue.submitted), len(USERS) * PHOTOS_PER_USER)
+        self.assertEqual(len(bot.errors), len(USERS) * failed)
+
+
+if __name__ == '__main__':
+    unittest.main()
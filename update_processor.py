@@ -0,0 +1,57 @@
+import asyncio
+import sys
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей обрабатываются параллельно, а обновления одного
+    # пользователя - строго по очереди, в порядке поступления: ConversationHandler
+    # и счетчики загрузки в сессии не видят гонок.
+    # Семафор базового класса не всегда пропускает задачи в порядке прихода, поэтому
+    # ему передается лимит без ограничения, а общее число одновременных обновлений
+    # ограничивается уже после очереди пользователя
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self.limit = max(max_concurrent_updates, 1)
+        self._slots = None
+        # ключ пользователя -> [замок, сколько обновлений его ждут или держат]
+        self._locks = {}
+
+    @staticmethod
+    def key_of(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.key_of(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.limit)
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,223 @@
+import asyncio
+import hmac
+import json
+import signal
+import ssl
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from telegram import Update
+
+import config
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+# Обновления Telegram небольшие, все крупнее считаем ошибкой клиента
+MAX_BODY_SIZE = 1024 * 1024
+# Ограничения на заголовки запроса: порт открыт наружу, и клиент не должен
+# занимать память бесконечным списком заголовков
+MAX_HEADERS = 100
+MAX_HEADERS_SIZE = 16 * 1024
+# За сколько секунд клиент должен передать запрос целиком. Медленное или молчащее
+# соединение закрывается и не задерживает остановку сервера
+REQUEST_TIMEOUT = 10
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed', 408: 'Request Timeout', 413: 'Payload Too Large',
+           431: 'Request Header Fields Too Large', 503: 'Service Unavailable'}
+
+
+class WebhookServer:
+    # Небольшой HTTP-сервер на asyncio: принимает обновления от Telegram на url_path
+    # и кладет их в update_queue приложения, а на health_path отвечает балансировщику.
+    # TLS обычно снимает прокси перед ботом, но можно передать и свой ssl_context
+
+    def __init__(self, application, listen, port, url_path, secret_token=None, health_path='/health',
+                 ssl_context=None):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+        self.health_path = health_path
+        self.ssl_context = ssl_context
+        self.draining = False
+        self._server = None
+        self._connections = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port, ssl=self.ssl_context)
+        print(f"Вебхук слушает {self.listen}:{self.port}{self.url_path}")
+
+    async def drain(self, timeout, grace_period=0):
+        # Новые обновления получают 503 и будут повторены Telegram, а уже принятые
+        # успевают обработаться до остановки приложения. Первые grace_period секунд
+        # сервер еще отвечает, чтобы балансировщик увидел 503 на health
+        self.draining = True
+        await asyncio.sleep(grace_period)
+        self._server.close()
+        # Открытые соединения завершатся не позже чем через REQUEST_TIMEOUT
+        if self._connections:
+            await asyncio.wait(self._connections, timeout=2 * REQUEST_TIMEOUT)
+        await self._server.wait_closed()
+        await wait_for_updates(self.application, timeout)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            await self._serve_connection(reader, writer)
+        finally:
+            self._connections.discard(task)
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            status, body = await asyncio.wait_for(self._respond(reader), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            status, body = 408, 'request timeout'
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            status, body = 400, str(e)
+        except Exception as e:
+            print(f"Ошибка обработки запроса вебхука: {e}")
+            status, body = 400, 'bad request'
+        data = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + data
+        )
+        try:
+            await asyncio.wait_for(writer.drain(), REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, reader):
+        request_line = (await reader.readuntil(b'\r\n')).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError('bad request line')
+        method, path, _ = request_line
+        headers = {}
+        headers_size = 0
+        while True:
+            line = (await reader.readuntil(b'\r\n')).decode('latin-1')
+            if line == '\r\n':
+                break
+            headers_size += len(line)
+            if len(headers) >= MAX_HEADERS or headers_size > MAX_HEADERS_SIZE:
+                return 431, 'request header fields too large'
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        path = path.split('?', 1)[0]
+        if path == self.health_path:
+            if method != 'GET':
+                return 405, 'method not allowed'
+            return (503, 'draining') if self.draining else (200, 'ok')
+        if path != self.url_path:
+            return 404, 'not found'
+        if method != 'POST':
+            return 405, 'method not allowed'
+        if self.secret_token and not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret_token):
+            return 403, 'forbidden'
+        if self.draining:
+            return 503, 'draining'
+
+        length = int(headers.get('content-length', '0'))
+        if length > MAX_BODY_SIZE:
+            return 413, 'payload too large'
+        payload = json.loads(await reader.readexactly(length))
+        await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+        return 200, 'ok'
+
+
+async def wait_for_updates(application, timeout):
+    deadline = time.monotonic() + timeout
+    while not application.update_queue.empty() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    left = application.update_queue.qsize()
+    if left:
+        print(f"Не дождались обработки обновлений: {left}")
+
+
+def get_ssl_context():
+    if not config.WEBHOOK_CERT:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(config.WEBHOOK_CERT, config.WEBHOOK_KEY)
+    return context
+
+
+async def serve(application):
+    # Тот же жизненный цикл, что у run_polling: post_init, прием обновлений,
+    # по SIGTERM/SIGINT - дренаж, остановка и post_shutdown
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = WebhookServer(application, config.WEBHOOK_LISTEN, config.WEBHOOK_PORT, config.WEBHOOK_PATH,
+                           config.WEBHOOK_SECRET, config.HEALTH_PATH, get_ssl_context())
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await server.start()
+    if config.WEBHOOK_URL:
+        await application.bot.set_webhook(
+            config.WEBHOOK_URL.rstrip('/') + server.url_path,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    await application.start()
+    try:
+        await stop.wait()
+    finally:
+        await server.drain(config.DRAIN_TIMEOUT, config.DRAIN_GRACE_PERIOD)
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run(application):
+    asyncio.run(serve(application))
+
+
+def post_fake_update(url, text='/start', user_id=1, secret=None):
+    # Отправляет на вебхук обновление, похожее на сообщение от Telegram, для локальной проверки
+    update = {
+        'update_id': int(time.time() * 1000) % 2 ** 31,
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': text,
+        },
+    }
+    if text.startswith('/'):
+        update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json'})
+    if secret:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+if __name__ == '__main__':
+    # python webhook.py post <url> [текст] [user_id]
+    if len(sys.argv) >= 3 and sys.argv[1] == 'post':
+        text = sys.argv[3] if len(sys.argv) > 3 else '/start'
+        user_id = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        print(post_fake_update(sys.argv[2], text, user_id, config.WEBHOOK_SECRET))
+    else:
+        print("Использование: python webhook.py post <url> [текст] [user_id]")
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import multiprocessing
+import queue as queue_module
+import signal
+import threading
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import config
+import webhook
+
+
+def shard_of(update, count):
+    # Все обновления одного пользователя попадают в один воркер, поэтому состояние
+    # ConversationHandler и сессия в памяти воркера остаются верными
+    if update.effective_user is not None:
+        key = update.effective_user.id
+    elif update.effective_chat is not None:
+        key = update.effective_chat.id
+    else:
+        key = 0
+    return abs(key) % count
+
+
+class WorkerPool:
+    # Процессы-воркеры с полноценным приложением бота. Обновления передаются
+    # каждому через свою очередь multiprocessing в виде JSON
+
+    def __init__(self, count):
+        self.count = count
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = []
+        self._processes = []
+
+    def start(self):
+        for index in range(self.count):
+            queue = self._context.Queue()
+            process = self._context.Process(target=run_worker, args=(index, self.count, queue),
+                                            name=f"worker-{index}")
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+        print(f"Запущено воркеров: {self.count}")
+
+    def send(self, update):
+        self._queues[shard_of(update, self.count)].put(update.to_json())
+
+    def stop(self, timeout):
+        # Пустое сообщение - сигнал воркеру доработать принятые обновления и завершиться
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                print(f"Воркер {process.name} не завершился вовремя")
+                process.terminate()
+        self._queues, self._processes = [], []
+
+
+def build_dispatcher(builder, count):
+    pool = WorkerPool(count)
+
+    async def forward(update, context):
+        pool.send(update)
+
+    async def on_startup(application):
+        pool.start()
+
+    async def on_shutdown(application):
+        # Воркер ждет сначала обработки обновлений, затем скачивания фотографий
+        await asyncio.get_running_loop().run_in_executor(None, pool.stop, 2 * config.DRAIN_TIMEOUT + 10)
+
+    application = (
+        builder
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, forward))
+    return application
+
+
+async def serve_worker(application, queue):
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+    def put(data):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    def receive():
+        # Очередь multiprocessing блокирующая, поэтому ее читает отдельный поток.
+        # Если диспетчер погиб, не попрощавшись, воркер тоже завершается
+        while True:
+            try:
+                data = queue.get(timeout=1)
+            except queue_module.Empty:
+                if multiprocessing.parent_process().is_alive():
+                    continue
+                data = None
+            if data is None:
+                loop.call_soon_threadsafe(stopped.set)
+                return
+            loop.call_soon_threadsafe(put, json.loads(data))
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    threading.Thread(target=receive, name='updates', daemon=True).start()
+    try:
+        await stopped.wait()
+    finally:
+        await webhook.wait_for_updates(application, config.DRAIN_TIMEOUT)
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_worker(index, count, queue):
+    # Ctrl+C и SIGTERM от менеджера сервисов получает вся группа процессов,
+    # а останавливает воркеры диспетчер, когда перестанет получать обновления
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    import main
+    application = main.build_application(shard=(index, count))
+    asyncio.run(serve_worker(application, queue))